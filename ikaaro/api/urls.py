@@ -24,7 +24,8 @@ from views import ApiDevPanel_ResourceJSON, ApiDevPanel_ResourceRaw, ApiDevPanel
 from views import ApiDevPanel_ClassidViewDetails, ApiDevPanel_ClassidViewList
 from views import ApiDevPanel_Config, ApiDevPanel_Log
 from views import ApiDevPanel_CatalogReindex, UUIDView
-from views import ApiDevPanel_ServerView, ApiDevPanel_ServerStop
+from views import ApiDevPanel_ServerView, ApiDevPanel_ServerStats
+from views import ApiDevPanel_ServerStop
 
 
 urlpatterns = [
@@ -48,5 +49,6 @@ urlpatterns = [
     urlpattern('/devpanel/catalog/reindex', ApiDevPanel_CatalogReindex),
     # Server
     urlpattern('/devpanel/server', ApiDevPanel_ServerView),
+    urlpattern('/devpanel/server/stats', ApiDevPanel_ServerStats),
     urlpattern('/devpanel/server/stop', ApiDevPanel_ServerStop),
 ]
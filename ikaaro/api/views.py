@@ -330,6 +330,19 @@ class ApiDevPanel_ServerView(Api_View):
 
 
 
+class ApiDevPanel_ServerStats(Api_View):
+    """ Return the hit/miss counters of the server caches
+    """
+
+    access = 'is_admin'
+    known_methods = ['GET']
+
+    def GET(self, root, context):
+        kw = context.server.get_stats()
+        return self.return_json(kw, context)
+
+
+
 class ApiDevPanel_ServerStop(Api_View):
     """ Stop the web server
     """
@@ -0,0 +1,315 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""In-memory cache of the static files of the skins (the "/ui" routes).
+
+The files are loaded when the server starts, with a gzip compressed copy
+of the text files. In the development environment the modification time
+of the files is checked on every request, to load them again when they
+change.
+
+Out of the development environment, the style sheets and scripts of a page
+are concatenated in bundles (see Skin.get_styles and Skin.get_scripts),
+served from "/ui/bundles/<hash>.css" and ".js". The style sheets are
+minified.
+"""
+
+# Import from the Standard Library
+from cStringIO import StringIO
+from datetime import datetime
+from gzip import GzipFile
+from hashlib import sha1
+from os import walk
+from os.path import basename, getmtime, getsize, join
+from posixpath import dirname, normpath
+import re
+from time import time
+
+# Import from itools
+from itools.core import fixed_offset
+from itools.fs.common import get_mimetype
+
+# Import from ikaaro
+from utils import get_etag
+
+
+# Files bigger than this are not kept in memory
+size_max = 1024 * 1024
+
+# Templates are loaded through the handlers (see IkaaroStaticView)
+skip_extensions = ('.xml', '.xhtml', '.html')
+
+
+def is_compressible(mimetype):
+    if mimetype.startswith('text/'):
+        return True
+    return mimetype in ('application/javascript', 'application/json',
+                        'application/x-javascript', 'application/xml',
+                        'image/svg+xml')
+
+
+def gzip_data(data):
+    output = StringIO()
+    # A fixed mtime, so the compressed data is always the same
+    file = GzipFile(fileobj=output, mode='wb', compresslevel=9, mtime=0)
+    file.write(data)
+    file.close()
+    return output.getvalue()
+
+
+
+###########################################################################
+# Bundles
+###########################################################################
+bundles_path = '/ui/bundles'
+
+# The comments, the URLs and the strings (the URLs before the strings they
+# may contain)
+css_token = re.compile(r"""(/\*.*?\*/)"""
+                       r"""|url\(\s*(['"]?)([^'")]+)\2\s*\)"""
+                       r"""|("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')""",
+                       re.DOTALL)
+css_space = re.compile(r'\s*([{};,>])\s*')
+css_kept = re.compile(r'\x00(\d+)\x00')
+whitespace = re.compile(r'\s+')
+
+
+def is_bundleable(path):
+    if not path.startswith('/ui/') or path.startswith(bundles_path):
+        return False
+    if '?' in path or '..' in path:
+        return False
+    return path.endswith('.css') or path.endswith('.js')
+
+
+def minify_css(data, path):
+    """Minify the style sheet, the relative URLs are made absolute since
+    the bundle is not in the same folder. The strings and the URLs are kept
+    as they are.
+    """
+    base = dirname(path)
+    kept = []
+    def keep(match):
+        comment, quote, url, string = match.groups()
+        if comment:
+            return ' '
+        if string:
+            kept.append(string)
+        else:
+            url = url.strip()
+            if url[0] != '/' and url[0] != '#' and ':' not in url:
+                url = normpath('%s/%s' % (base, url))
+            kept.append('url(%s%s%s)' % (quote, url, quote))
+        return '\x00%d\x00' % (len(kept) - 1)
+
+    data = css_token.sub(keep, data)
+    data = whitespace.sub(' ', data)
+    data = css_space.sub(r'\1', data)
+    data = css_kept.sub(lambda x: kept[int(x.group(1))], data)
+    return data.strip()
+
+
+
+class StaticAsset(object):
+    """A static file. If it is not kept in memory (kept=False) the entity tag
+    is made from the modification time, and there is no compressed copy.
+    """
+
+    def __init__(self, local_path, data, mimetype, kept=True):
+        self.local_path = local_path
+        self.data = data
+        self.mimetype = mimetype
+        # Modification time (now for the bundles)
+        self.file_mtime = getmtime(local_path) if local_path else time()
+        mtime = datetime.utcfromtimestamp(self.file_mtime)
+        mtime = mtime.replace(microsecond=0)
+        self.mtime = fixed_offset(0).localize(mtime)
+        if kept:
+            self.etag = get_etag(data)
+        else:
+            self.etag = get_etag(local_path, self.file_mtime)
+        # Compressed copy (if worth it)
+        self.gzip = None
+        if kept and is_compressible(mimetype):
+            compressed = gzip_data(data)
+            if len(compressed) < len(data):
+                self.gzip = compressed
+
+
+    def is_stale(self):
+        if self.local_path is None:
+            return False
+        try:
+            return getmtime(self.local_path) != self.file_mtime
+        except OSError:
+            return True
+
+
+
+class AssetCache(object):
+
+    def __init__(self):
+        self.assets = {}
+        # {paths: paths with the bundles}
+        self.bundles = {}
+        self.check_mtime = False
+        self.stats = {'hit': 0, 'miss': 0}
+
+
+    def load(self, server):
+        """Load the static files of all the skins, the files of the
+        environment key (see Skin.get_environment_key) have precedence.
+        """
+        from skins import skin_registry
+
+        self.assets = {}
+        self.bundles = {}
+        self.check_mtime = server.is_development_environment()
+        for name, skin in skin_registry.items():
+            keys = [skin.key]
+            environment_key = skin.get_environment_key(server)
+            if environment_key != skin.key:
+                keys.append(environment_key)
+            for key in keys:
+                self.load_folder(key, skin.base_path)
+
+
+    def load_folder(self, local_path, base_path):
+        for dirpath, dirnames, filenames in walk(local_path):
+            for filename in filenames:
+                if filename.endswith(skip_extensions):
+                    continue
+                path = join(dirpath, filename)
+                if getsize(path) > size_max:
+                    continue
+                web_path = base_path + path[len(local_path):]
+                with open(path, 'rb') as f:
+                    data = f.read()
+                self.set(web_path, path, data, get_mimetype(filename))
+
+
+    def get(self, path):
+        asset = self.assets.get(path)
+        if asset is None or (self.check_mtime and asset.is_stale()):
+            self.stats['miss'] += 1
+            return None
+        self.stats['hit'] += 1
+        return asset
+
+
+    def can_keep(self, path, local_path, data):
+        # Only the exact matches are kept (not the language variants)
+        return basename(local_path) == basename(path) and len(data) <= size_max
+
+
+    def set(self, path, local_path, data, mimetype):
+        kept = self.can_keep(path, local_path, data)
+        asset = StaticAsset(local_path, data, mimetype, kept)
+        if kept:
+            self.assets[path] = asset
+        return asset
+
+
+    def lookup(self, path, context):
+        """Return the asset of the given path, loaded through the handlers
+        if not in memory yet. Return None if there is not such a file.
+        """
+        asset = self.get(path)
+        if asset is not None:
+            return asset
+        # FIXME Check we set the encoding for text files
+        template = context.get_template(path)
+        if not template:
+            return None
+        mimetype = template.get_mimetype()
+        data = template.to_str()
+        return self.set(path, template.key, data, mimetype)
+
+
+    def bundle(self, paths, context):
+        """Return the given list of style sheets or scripts, where every
+        sequence of local files is replaced by its bundle. The result is
+        kept, so it is computed once by list.
+        """
+        if self.check_mtime:
+            return paths
+        key = tuple(paths)
+        result = self.bundles.get(key)
+        if result is not None:
+            return list(result)
+
+        result = []
+        files = []
+        for path in paths + [None]:
+            if path is not None and is_bundleable(path):
+                if files and path[-3:] != files[0][-3:]:
+                    result.extend(self.make_bundle(files, context))
+                    files = []
+                files.append(path)
+                continue
+            if files:
+                result.extend(self.make_bundle(files, context))
+                files = []
+            if path is not None:
+                result.append(path)
+
+        self.bundles[key] = result
+        return list(result)
+
+
+    def make_bundle(self, files, context):
+        """Return the list with the URL of the bundle of the given files, or
+        the files themselves if they cannot be bundled. The files are in the
+        query, so any process can make the bundle again.
+        """
+        if len(files) < 2:
+            return files
+        asset = self.get_bundle(files, context)
+        if asset is None:
+            return files
+        path = self.get_bundle_path(files, asset)
+        self.assets[path] = asset
+        return ['%s?files=%s' % (path, ','.join(files))]
+
+
+    def get_bundle_path(self, files, asset):
+        """The path of the bundle is the hash of its content.
+        """
+        return '%s/%s%s' % (bundles_path, sha1(asset.data).hexdigest(),
+                            files[0][files[0].rfind('.'):])
+
+
+    def get_bundle(self, files, context):
+        is_css = files[0].endswith('.css')
+        data = []
+        for path in files:
+            asset = self.lookup(path, context)
+            if asset is None:
+                return None
+            # The @import rules must be at the start of the style sheet
+            if is_css and '@import' in asset.data:
+                return None
+            # The scripts are not minified, the lines cannot be changed
+            # without parsing them (multi-line strings and templates)
+            data.append(minify_css(asset.data, path) if is_css
+                        else asset.data)
+
+        if is_css:
+            return StaticAsset(None, '\n'.join(data), 'text/css')
+        return StaticAsset(None, ';\n'.join(data), 'application/javascript')
+
+
+
+static_assets = AssetCache()
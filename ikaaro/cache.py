@@ -0,0 +1,190 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""In-process caches of values computed from the database.
+
+Every cache declares the paths it depends on, it is cleared by the commits
+that change a resource at (or below) one of these paths. A read-only server
+does not know what changed, it clears all the caches when the read-write
+server commits.
+
+The values may also expire after some time (ttl, in seconds).
+"""
+
+# Import from the Standard Library
+from time import time
+
+# Import from itools
+from itools.core import LRUCache
+
+
+caches_registry = {}
+
+
+def is_prefix(prefixes, path):
+    """Tells whether the path is one of the prefixes, or below one of them.
+    """
+    for prefix in prefixes:
+        if path == prefix or path.startswith(prefix + '/'):
+            return True
+    return False
+
+
+class Cache(object):
+
+    def __init__(self, name, depends=(), size_min=900, size_max=1100,
+                 ttl=None):
+        self.name = name
+        self.depends = tuple(depends)
+        self.ttl = ttl
+        self.values = LRUCache(size_min, size_max)
+        self.stats = {'hit': 0, 'miss': 0}
+        caches_registry[name] = self
+
+
+    def get(self, key, default=None):
+        if key in self.values:
+            value, expires = self.values[key]
+            if expires is None or expires > time():
+                self.stats['hit'] += 1
+                self.values.touch(key)
+                return value
+            del self.values[key]
+        self.stats['miss'] += 1
+        return default
+
+
+    def set(self, key, value):
+        expires = time() + self.ttl if self.ttl else None
+        # The LRU cache does not support to replace a value
+        if key in self.values:
+            del self.values[key]
+        self.values[key] = (value, expires)
+
+
+    def pop(self, key):
+        if key in self.values:
+            return self.values.pop(key)[0]
+        return None
+
+
+    def clear(self):
+        self.values.clear()
+
+
+    def depends_on(self, path):
+        return is_prefix(self.depends, path)
+
+
+    def invalidate(self, paths):
+        """Called on commit with the paths of the resources that changed.
+        """
+        for path in paths:
+            if self.depends_on(path):
+                self.clear()
+                return
+
+
+
+class PageCache(Cache):
+    """Cache of whole responses. Every entry has its own dependencies (the
+    paths of the resources it was built from), and once expired it may be
+    served for a while (stale) until it is computed again.
+    """
+
+    def __init__(self, name, size=1000, ttl=0, stale=0):
+        super(PageCache, self).__init__(name, size_min=size,
+                                        size_max=size + size / 10)
+        self.stale = stale
+        self.ttl = ttl
+        self.stats['stale'] = 0
+
+
+    def configure(self, size, ttl, stale):
+        self.values = LRUCache(size, size + size / 10)
+        self.ttl = ttl
+        self.stale = stale
+
+
+    def lookup(self, key):
+        """Return the tuple (response, revalidate), the response is None
+        if there is not a fresh or stale entry. The 'revalidate' flag is
+        True only the first time a stale entry is served, then it is up to
+        the caller to compute it again.
+        """
+        entry = self.values.get(key)
+        if entry is not None:
+            response, depends, expires = entry
+            now = time()
+            if now < expires:
+                self.stats['hit'] += 1
+                self.values.touch(key)
+                return response, False
+            if now < expires + self.stale:
+                self.stats['stale'] += 1
+                # Serve it stale, but only ask once to revalidate
+                self.set(key, response, depends, expires + self.stale)
+                return response, True
+            del self.values[key]
+        self.stats['miss'] += 1
+        return None, False
+
+
+    def set(self, key, response, depends, expires=None):
+        if expires is None:
+            expires = time() + self.ttl
+        if key in self.values:
+            del self.values[key]
+        self.values[key] = (response, tuple(depends), expires)
+
+
+    def pop(self, key):
+        if key in self.values:
+            return self.values.pop(key)[0]
+        return None
+
+
+    def invalidate(self, paths):
+        to_remove = []
+        for key in self.values:
+            depends = self.values[key][1]
+            for path in paths:
+                if is_prefix(depends, path):
+                    to_remove.append(key)
+                    break
+        for key in to_remove:
+            del self.values[key]
+
+
+
+def invalidate_caches(paths):
+    paths = [ str(x) for x in paths ]
+    for cache in caches_registry.itervalues():
+        cache.invalidate(paths)
+
+
+def clear_caches():
+    for cache in caches_registry.itervalues():
+        cache.clear()
+
+
+def get_caches_stats():
+    stats = {}
+    for name, cache in caches_registry.iteritems():
+        value = dict(cache.stats)
+        total = sum(value.values())
+        value['ratio'] = float(total - value['miss']) / total if total else 0
+        stats[name] = value
+    return stats
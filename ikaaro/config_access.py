@@ -29,10 +29,11 @@ from ikaaro.views.folder_views import Folder_BrowseContent
 from autoadd import AutoAdd
 from autoedit import AutoEdit
 from buttons import Remove_BrowseButton
+from cache import Cache, is_prefix
 from config import Configuration
 from config_common import NewResource_Local
 from enumerates import Groups_Datatype
-from fields import Select_Field
+from fields import Integer_Field, Select_Field
 from folder import Folder
 from resource_ import DBResource
 from utils import get_base_path_query
@@ -189,10 +190,47 @@ class AccessRule(DBResource):
         return query
 
 
+    def update_resource(self, context):
+        super(AccessRule, self).update_resource(context)
+        # The allowed viewers of the resources must be computed again
+        if self.metadata.dirty:
+            self.parent.touch_viewers_index()
+
+
 
 ###########################################################################
 # Configuration module
 ###########################################################################
+# The compiled access rules, by (user groups, permission, class_id)
+rules_queries = Cache('access_rules', depends=['/config/access'])
+
+# The state of the background re-indexation of the allowed viewers
+viewers_index_job = {'serial': None, 'paths': []}
+
+
+def match_view_rule(rule, abspath, format):
+    """Tells whether the compiled view rule (see
+    ConfigAccess.get_view_rules) applies to the resource at the given path.
+    """
+    group, path, depth, r_format = rule
+    if r_format and r_format != format:
+        return False
+    # Same semantics as get_base_path_query(path, 0, depth)
+    if not path or (path == '/' and depth is None):
+        return True
+    if depth == 0:
+        return abspath == path
+
+    if abspath == path or abspath == path.rstrip('/'):
+        return True
+    if not abspath.startswith(path.rstrip('/') + '/'):
+        return False
+    if depth is None:
+        return True
+    return abspath.count('/') <= path.rstrip('/').count('/') + depth
+
+
+
 class ConfigAccess_Browse(Folder_BrowseContent):
 
     query_schema = merge_dicts(
@@ -287,7 +325,7 @@ class ConfigAccess_Browse(Folder_BrowseContent):
 class ConfigAccess(Folder):
 
     class_id = 'config-access'
-    class_version = '20110606'
+    class_version = '20261018'
     class_title = MSG(u'Access Control')
     class_description = MSG(u'Choose the security policy.')
     class_icon_css = 'fa-user-plus'
@@ -296,6 +334,10 @@ class ConfigAccess(Folder):
     config_name = 'access'
     config_group = 'access'
 
+    # Fields
+    viewers_index_serial = Integer_Field(default=0)
+    viewers_index_done = Integer_Field(default=0)
+
     # Initialization
     _everything = freeze({'path': '/', 'path_depth': '*'})
     default_rules = [
@@ -338,7 +380,55 @@ class ConfigAccess(Folder):
         if is_admin:
             return AllQuery()
 
+        # Use the allowed viewers index, unless it is being rebuilt
+        if permission == 'view' and self.is_viewers_index_ready():
+            return self.get_viewers_query(user, user_groups)
+
         # 1. Back-office access rules
+        rules_query = self.get_rules_query(user_groups, permission, class_id)
+
+        # Case: anonymous
+        if not user:
+            return AndQuery(rules_query, PhraseQuery('share', 'everybody'))
+
+        # Case: authenticated
+        share_query = OrQuery(*[ PhraseQuery('share', x)
+                                 for x in user_groups ])
+        share_query.append(PhraseQuery('share', str(user.abspath)))
+        query = AndQuery(rules_query, share_query)
+
+        if permission != 'share':
+            return OrQuery(PhraseQuery('owner', str(user.abspath)), query)
+
+        return query
+
+
+    def has_changed_rules(self):
+        """Tells whether the access rules have changes not committed yet,
+        then the cache of the rules is not used.
+        """
+        database = self.database
+        changed = getattr(database, 'resources_old2new', {}).keys()
+        changed.extend(getattr(database, 'resources_new2old', {}).keys())
+        prefixes = [str(self.abspath)]
+        for path in changed:
+            if is_prefix(prefixes, path):
+                return True
+        return False
+
+
+    def get_rules_query(self, user_groups, permission, class_id=None):
+        """Return the query of the access rules that give the permission to
+        any of the given groups. It is cached until a resource below
+        "/config/access" changes.
+        """
+        changed = self.has_changed_rules()
+        key = (frozenset(user_groups), permission, class_id)
+        if not changed:
+            rules_query = rules_queries.get(key)
+            if rules_query is not None:
+                return rules_query
+
         rules_query = OrQuery()
         for rule in self.get_resources():
             if rule.get_value('permission') != permission:
@@ -354,31 +444,172 @@ class ConfigAccess(Folder):
 
             rules_query.append(rule.get_search_query())
 
-        # Case: anonymous
+        if not changed:
+            rules_queries.set(key, rules_query)
+        return rules_query
+
+
+    #######################################################################
+    # Allowed viewers
+    #######################################################################
+    def get_viewers_query(self, user, user_groups):
+        """Return the query matching the resources the user can view, using
+        the terms computed by 'get_allowed_viewers'.
+        """
         if not user:
-            return AndQuery(rules_query, PhraseQuery('share', 'everybody'))
+            return PhraseQuery('allowed_viewers', 'everybody|everybody')
+
+        userid = str(user.abspath)
+        principals = set(user_groups)
+        principals.add(userid)
+        query = OrQuery(*[ PhraseQuery('allowed_viewers', '%s|%s' % (x, y))
+                           for x in user_groups for y in principals ])
+        query.append(PhraseQuery('allowed_viewers', userid))
+        return query
 
-        # Case: authenticated
-        share_query = OrQuery(*[ PhraseQuery('share', x)
-                                 for x in user_groups ])
-        share_query.append(PhraseQuery('share', str(user.abspath)))
-        query = AndQuery(rules_query, share_query)
 
-        if permission != 'share':
-            return OrQuery(PhraseQuery('owner', str(user.abspath)), query)
+    def get_view_rules(self):
+        """Return the view rules as tuples (group, path, depth, format),
+        cached like the rules queries.
+        """
+        changed = self.has_changed_rules()
+        if not changed:
+            rules = rules_queries.get('view_rules')
+            if rules is not None:
+                return rules
 
-        return query
+        rules = []
+        for rule in self.get_resources():
+            if rule.get_value('permission') != 'view':
+                continue
+            path = rule.get_value('search_path')
+            path = str(path) if path else None
+            depth = rule.get_value('search_path_depth')
+            depth = None if depth == '*' else int(depth)
+            r_format = rule.get_value('search_format')
+            rules.append((rule.get_value('group'), path, depth, r_format))
+
+        if not changed:
+            rules_queries.set('view_rules', rules)
+        return rules
+
+
+    def get_allowed_viewers(self, resource, owner, share):
+        """Return the terms to index in the 'allowed_viewers' field of the
+        given resource: the owner, and a "group|share" term for every group
+        that has a view rule on the resource.
+        """
+        values = []
+        if owner:
+            values.append(str(owner))
+
+        if share:
+            abspath = str(resource.abspath)
+            format = resource.metadata.format
+            groups = set([ rule[0] for rule in self.get_view_rules()
+                           if match_view_rule(rule, abspath, format) ])
+            for group in groups:
+                for value in share:
+                    values.append('%s|%s' % (group, value))
+
+        return values
+
+
+    def touch_viewers_index(self):
+        serial = self.get_value('viewers_index_serial')
+        self.set_value('viewers_index_serial', serial + 1)
+        # Re-index once committed
+        context = get_context()
+        server = context.server if context else None
+        if server is not None:
+            self.database.call_after_commit(server.launch_viewers_index)
+
+
+    def is_viewers_index_ready(self):
+        serial = self.get_value('viewers_index_serial')
+        return serial == self.get_value('viewers_index_done')
+
+
+    def update_viewers_index(self, size=500):
+        """Re-index the next batch of resources after a change of the access
+        rules. Returns True if there is more work to do.
+        """
+        serial = self.get_value('viewers_index_serial')
+        if serial == self.get_value('viewers_index_done'):
+            return False
+
+        # Start again if the rules changed during the re-indexation
+        job = viewers_index_job
+        if job['serial'] != serial:
+            search = self.database.search(AllQuery())
+            job['serial'] = serial
+            job['paths'] = [ x.abspath for x in search.get_documents() ]
+
+        # Next batch
+        paths = job['paths']
+        for path in paths[:size]:
+            resource = self.get_resource(path, soft=True)
+            if resource is not None:
+                resource.reindex()
+        del paths[:size]
+
+        # Done
+        if not paths:
+            self.set_value('viewers_index_done', serial)
+            job['serial'] = None
+            return False
+        return True
+
+
+    def del_resource(self, name, soft=False, ref_action='restrict'):
+        proxy = super(ConfigAccess, self)
+        proxy.del_resource(name, soft=soft, ref_action=ref_action)
+        self.touch_viewers_index()
 
 
     def has_permission(self, user, permission, resource, class_id=None):
-        # The query
-        query = AndQuery(
-            self.get_search_query(user, permission, class_id),
-            PhraseQuery('abspath', str(resource.abspath)))
+        paths = self.has_permissions(user, permission, [resource], class_id)
+        return str(resource.abspath) in paths
 
-        # Search
-        results = get_context().search(query, user=user)
-        return len(results) > 0
+
+    def has_permissions(self, user, permission, resources, class_id=None):
+        """Return the set of the abspaths of the given resources on which
+        the user has the permission.
+
+        The answers are kept in the context for the rest of the request, so
+        a page of resources is checked with one catalog search, and the
+        checks done later on one of them do not search again.
+        """
+        context = get_context()
+        memo = context.permissions
+        userid = str(user.abspath) if user else None
+        key = (userid, permission, class_id)
+
+        allowed = set()
+        todo = []
+        for resource in resources:
+            abspath = str(resource.abspath)
+            value = memo.get(key + (abspath,))
+            if value is None:
+                todo.append(abspath)
+            elif value is True:
+                allowed.add(abspath)
+
+        if not todo:
+            return allowed
+
+        # Search (by chunks of 200, Xapian is slow with big OrQueries)
+        query = self.get_search_query(user, permission, class_id)
+        found = set()
+        for i in range(0, len(todo), 200):
+            subquery = OrQuery(*[ PhraseQuery('abspath', x)
+                                  for x in todo[i:i+200] ])
+            results = context.search(AndQuery(query, subquery), user=user)
+            found.update([ x.abspath for x in results.get_documents() ])
+
+        for abspath in todo:
+            memo[key + (abspath,)] = abspath in found
+        return allowed | found
 
 
     def get_document_types(self):
@@ -391,6 +622,12 @@ class ConfigAccess(Folder):
     add_rule = NewResource_Local(title=MSG(u'Add rule'))
 
 
+    # Upgrade
+    update_20261018_title = MSG(u'Index the allowed viewers')
+    def update_20261018(self):
+        self.touch_viewers_index()
+
+
 
 # Register
 Configuration.register_module(ConfigAccess)
@@ -140,7 +140,18 @@ class MenuItem(OrderedFolder):
         here_abspath_and_view = '%s/%s' % (here_abspath, here_view_name)
         items = []
 
-        for resource in self.get_resources_in_order():
+        # Check the access to the linked resources at once
+        menu_items = list(self.get_resources_in_order())
+        resources = []
+        for resource in menu_items:
+            ref, path, view = split_reference(resource.get_value('path'))
+            if ref is not None and path and not ref.scheme:
+                resource = self.get_resource(path, soft=True)
+                if resource is not None:
+                    resources.append(resource)
+        context.root.has_permissions(context.user, 'view', resources)
+
+        for resource in menu_items:
             uri = resource.get_value('path')
             if not self._is_allowed_to_access(context, uri):
                 continue
@@ -16,6 +16,7 @@
 
 # Import from standard library
 from base64 import decodestring, encodestring
+from cStringIO import StringIO
 from datetime import datetime, timedelta
 import json
 from hashlib import sha224
@@ -41,7 +42,15 @@ from itools.web.headers import get_type, Cookie, SetCookieDataType
 from itools.web.utils import NewJSONEncoder, fix_json, reason_phrases
 
 # Import from ikaaro
+from cache import Cache
 from skins import skin_registry
+from templates import template_registry
+from web.multipart import read_multipart
+
+
+# The authentication credentials already checked, (username, token, user
+# agent) to the abspath of the user.
+auth_cache = Cache('auth', depends=['/users'], ttl=300)
 
 
 class CMSContext(prototype):
@@ -56,13 +65,17 @@ class CMSContext(prototype):
     environ = {}
     form = {}
     form_error = None
+    group_commit = None # See Database.join_group
+    group_flush = False
     header_response = []
+    indexing = None # See IndexingCache
     is_cron = False
     message = None
     method = None
     mtime = None # Last-Modified
     path_query_base = None
     query = {}
+    read_only = False
     request_time = 0
     resource = None
     root = None
@@ -210,6 +223,14 @@ class CMSContext(prototype):
 
     def get_template_from_skin_key(self, skin_key, web_path, warning):
         local_path = skin_key + web_path
+        # Files of the skins, indexed when the server starts
+        if template_registry.has_path(local_path):
+            handler = template_registry.get_template(local_path,
+                                                     self.accept_language)
+            if handler and warning:
+                print warning
+            return handler
+
         # 3. Get the handler
         handler = ro_database.get_handler(local_path, soft=True)
         if handler:
@@ -339,6 +360,8 @@ class CMSContext(prototype):
 
     def http_not_modified(self):
         self.status = 304
+        # A 304 response has no body
+        self.entity = None
         self.set_response_from_context()
 
 
@@ -471,6 +494,10 @@ class CMSContext(prototype):
 
 
     def get_body_from_environ(self):
+        # Case 0: multipart, already read (see ikaaro.web.wsgi)
+        form = self.environ.get('ikaaro.multipart')
+        if form is not None:
+            return form
         # Get content type
         response = self.get_header('content-type')
         try:
@@ -479,6 +506,13 @@ class CMSContext(prototype):
             content_type = response
         # Case 1: nothing
         length = int(self.environ.get('CONTENT_LENGTH', '0') or 0)
+        if not length:
+            return {}
+        # Multipart bodies are read by chunks, see ikaaro.web.multipart
+        if content_type and content_type.startswith('multipart/'):
+            boundary = type_parameters.get('boundary')
+            return read_multipart(self.environ['wsgi.input'], length,
+                                  boundary)
         body = self.environ['wsgi.input'].read(length)
         if not body:
             return {}
@@ -499,43 +533,9 @@ class CMSContext(prototype):
 
 
     def get_multipart_body(self, body):
-        from itools.web.entities import Entity
         content_type, type_parameters = self.get_header('content-type')
         boundary = type_parameters.get('boundary')
-        boundary = '--%s' % boundary
-        form = {}
-        for part in body.split(boundary)[1:-1]:
-            # Parse the entity
-            entity = Entity(string=part)
-            # Find out the parameter name
-            header = entity.get_header('Content-Disposition')
-            value, header_parameters = header
-            name = header_parameters['name']
-            # Load the value
-            body = entity.get_body()
-            if 'filename' in header_parameters:
-                filename = header_parameters['filename']
-                if filename:
-                    # Strip the path (for IE).
-                    filename = filename.split('\\')[-1]
-                    # Default content-type, see
-                    # http://tools.ietf.org/html/rfc2045#section-5.2
-                    if entity.has_header('content-type'):
-                        mimetype = entity.get_header('content-type')[0]
-                    else:
-                        mimetype = 'text/plain'
-                    form[name] = filename, mimetype, body
-                else:
-                    form[name] = None
-            else:
-                if name not in form:
-                    form[name] = body
-                else:
-                    if isinstance(form[name], list):
-                        form[name].append(body)
-                    else:
-                        form[name] = [form[name], body]
-        return form
+        return read_multipart(StringIO(body), len(body), boundary)
 
     #######################################################################
     # ACL API
@@ -568,6 +568,21 @@ class CMSContext(prototype):
 
         return method(user, resource)
 
+    @proto_lazy_property
+    def resources_map(self):
+        """The resources loaded during the request, by path. See
+        ikaaro.database.ResourcesMap
+        """
+        return {}
+
+
+    @proto_lazy_property
+    def permissions(self):
+        """Memo of the permissions checked during the request, by (user,
+        permission, class_id, abspath). See ConfigAccess.has_permissions
+        """
+        return {}
+
     #######################################################################
     # Search
     #######################################################################
@@ -660,15 +675,24 @@ class CMSContext(prototype):
         if not username or not token:
             return
 
-        # 2. Get the user
+        # 2. Already checked
+        ua = self.get_header('X-User-Agent') or self.get_header('User-Agent')
+        key = (username, token, ua)
+        abspath = auth_cache.get(key)
+        if abspath is not None:
+            self.user = self.root.get_resource(abspath, soft=True)
+            return
+
+        # 3. Get the user
         user = self.root.get_user(username)
         if not user:
             return
 
-        # 3. Check the token
+        # 4. Check the token
         user_token = user.get_auth_token()
         if token == self._get_auth_token(user_token):
             self.user = user
+            auth_cache.set(key, str(user.abspath))
 
 
 
@@ -16,45 +16,236 @@
 
 # Import from standard library
 from copy import deepcopy
+from time import time
 
 # Import from gevent
+from gevent import getcurrent, spawn_later
+from gevent.event import AsyncResult
 from gevent.lock import BoundedSemaphore
+from greenlet import settrace
 
 # Import from itools
 from itools.database import RWDatabase, RODatabase as BaseRODatabase
 from itools.database import OrQuery, PhraseQuery, AndQuery
+from itools.log import log_error, log_info, log_warning
 from itools.uri import Path
 from itools.web import get_context, set_context
 
+# Import from ikaaro
+from cache import invalidate_caches, is_prefix
 
-DBSEM = BoundedSemaphore(1)
 
 
-class RODatabase(BaseRODatabase):
+class DatabaseLock(object):
+    """Readers/writer lock on the database: any number of readers or a
+    single writer. A waiting writer blocks the readers that come after it,
+    so writes are not starved by a continuous flow of reads.
+    """
+
+    def __init__(self):
+        self.readers = 0
+        self.mutex = BoundedSemaphore(1)
+        self.room = BoundedSemaphore(1)
+        self.turnstile = BoundedSemaphore(1)
+
+
+    def acquire(self, shared=False):
+        if shared is False:
+            self.turnstile.acquire()
+            self.room.acquire()
+            return
+        self.turnstile.acquire()
+        self.turnstile.release()
+        with self.mutex:
+            self.readers += 1
+            if self.readers == 1:
+                self.room.acquire()
+
+
+    def release(self, shared=False):
+        if shared is False:
+            self.turnstile.release()
+            self.room.release()
+            return
+        with self.mutex:
+            self.readers -= 1
+            if self.readers == 0:
+                self.room.release()
+
+
+DBLOCK = DatabaseLock()
+
+
+###########################################################################
+# One context per greenlet
+###########################################################################
+# The itools context is a global variable. When several requests share the
+# database (the "readers" lock mode) we keep one context per greenlet, and
+# restore it every time gevent switches from one greenlet to another.
+greenlet_contexts = {}
+
+def switch_context(event, args):
+    if event in ('switch', 'throw'):
+        origin, target = args
+        set_context(greenlet_contexts.get(target))
+
+
+def enable_greenlet_contexts():
+    settrace(switch_context)
+
+
+
+class ResourcesMap(object):
+    """Identity map: within a context (request or transaction), the same
+    path gives the same resource instance, so what it computes lazily is
+    computed once. The map is cleared by every commit, and when it grows
+    over "resources_map_size" (long transactions, like the updates).
+    """
+
+    resources_map_size = 5000
+
+    def get_resources_map(self):
+        context = get_context()
+        if context is None or context.database is not self:
+            return None
+        return context.resources_map
+
+
+    def get_resource(self, abspath, soft=False):
+        resources = self.get_resources_map()
+        if resources is None:
+            return super(ResourcesMap, self).get_resource(abspath, soft)
+
+        abspath = Path(abspath)
+        key = '/' + '/'.join(abspath)
+        resource = resources.get(key)
+        if resource is None:
+            proxy = super(ResourcesMap, self)
+            resource = proxy.get_resource(abspath, soft=soft)
+            if resource is not None:
+                if len(resources) >= self.resources_map_size:
+                    resources.clear()
+                resources[key] = resource
+        return resource
+
+
+    def forget_resources(self, abspath):
+        """Remove from the map the resource at the given path, and the
+        resources below it.
+        """
+        resources = self.get_resources_map()
+        if not resources:
+            return
+        prefix = '/' + '/'.join(Path(abspath))
+        for key in resources.keys():
+            if is_prefix([prefix], key) or prefix == '/':
+                del resources[key]
+
+
+
+###########################################################################
+# Dependencies between resources (onchange_reindex)
+###########################################################################
+class OnchangeIndex(object):
+    """In-memory copy of the "onchange_reindex" field of the catalog, so the
+    commits find out the resources to re-index without searching. It is
+    loaded from the catalog when the server starts, and updated once the
+    commits are done.
+    """
+
+    def __init__(self):
+        # {target: set([source, ...])}
+        self.sources = {}
+        # {source: set([target, ...])}
+        self.targets = {}
+
+
+    def load(self, database):
+        self.sources = {}
+        self.targets = {}
+        catalog = database.catalog
+        for target in catalog.get_unique_values('onchange_reindex'):
+            search = database.search(PhraseQuery('onchange_reindex', target))
+            for brain in search.get_documents():
+                self.add(brain.abspath, [target])
+
+
+    def add(self, source, targets):
+        self.targets.setdefault(source, set()).update(targets)
+        for target in targets:
+            self.sources.setdefault(target, set()).add(source)
+
+
+    def remove(self, source):
+        for target in self.targets.pop(source, ()):
+            sources = self.sources.get(target)
+            if sources is not None:
+                sources.discard(source)
+                if not sources:
+                    del self.sources[target]
 
-    def init_context(self, user=None, username=None, email=None, commit_at_exit=True):
+
+    def update(self, indexed, unindexed):
+        """Called after the commit: the first argument is a list with the
+        indexed resources and the values of their onchange_reindex field,
+        the second argument is the list of the unindexed resources.
+        """
+        for source in unindexed:
+            self.remove(source)
+        for source, targets in indexed:
+            self.remove(source)
+            if targets:
+                self.add(source, [ str(x) for x in targets ])
+
+
+    def get_sources(self, paths):
+        sources = set()
+        for path in paths:
+            sources.update(self.sources.get(path, ()))
+        return sources
+
+
+
+class RODatabase(ResourcesMap, BaseRODatabase):
+
+    def init_context(self, user=None, username=None, email=None,
+                     commit_at_exit=True, read_only=False):
         from ikaaro.context import CMSContext
         root = self.get_resource('/', soft=True)
         cls = root.context_cls if root else CMSContext
-        return ContextManager(cls, self)
+        return ContextManager(cls, self, read_only=read_only)
 
 
 
 class ContextManager(object):
 
-    def __init__(self, cls, database, user=None, username=None, email=None, commit_at_exit=True):
+    def __init__(self, cls, database, user=None, username=None, email=None,
+                 commit_at_exit=True, read_only=False):
         # Check if context is not already locked
         if get_context() != None:
             raise ValueError('Cannot acquire context. Already locked.')
-        # Acquire lock on database
-        DBSEM.acquire()
         from server import get_server
+        server = get_server()
+        # Acquire lock on database (read-only contexts share the database
+        # with other readers if the server is configured to do so)
+        self.shared = bool(read_only and server and server.concurrent_readers)
+        DBLOCK.acquire(self.shared)
+        # Read-only contexts do not see the changes of a group commit until
+        # they are saved (they may be lost)
+        group = getattr(database, 'group', None)
+        while read_only and group:
+            DBLOCK.release(self.shared)
+            group[-1][2].wait()
+            DBLOCK.acquire(self.shared)
+            group = database.group
         self.context = cls()
         self.context.database = database
-        self.context.server = get_server()
+        self.context.server = server
+        self.context.read_only = self.shared
         self.commit_at_exit = commit_at_exit
         # Set context
         set_context(self.context)
+        greenlet_contexts[getcurrent()] = self.context
         # Get user by user
         if email:
             query = AndQuery(
@@ -78,47 +269,375 @@ class ContextManager(object):
 
     def __exit__(self, exc_type, exc_value, traceback):
         try:
+            database = self.context.database
             if self.commit_at_exit:
-                self.context.database.save_changes()
+                database.save_changes()
             else:
-                if self.context.database.has_changed:
-                    msg = 'Warning: Some changes have not been commited'
-                    print(msg)
-        except Exception:
+                # The changes kept for a group commit are not a problem
+                has_own_changes = getattr(database, 'has_own_changes', None)
+                if has_own_changes is None:
+                    has_changed = database.has_changed
+                else:
+                    has_changed = database.has_changed and has_own_changes()
+                if has_changed:
+                    log_warning('Some changes have not been commited',
+                                domain='ikaaro')
+        finally:
+            greenlet_contexts.pop(getcurrent(), None)
             set_context(None)
-            DBSEM.release()
-            raise
-        else:
-            set_context(None)
-            DBSEM.release()
-
-
-
-
+            DBLOCK.release(self.shared)
 
 
 
-class Database(RWDatabase):
+class Database(ResourcesMap, RWDatabase):
     """Adds a Git archive to the itools database.
     """
 
-    def init_context(self, user=None, username=None, email=None, commit_at_exit=True):
+    # Incremented on every commit that changed something
+    generation = 0
+    # Incremented on every change to a handler (see DBResource.get_value)
+    changes = 0
+    # The in-memory index of the dependencies (see load_onchange_index)
+    onchange_index = None
+    # Group commit (see join_group): the number of seconds to wait for
+    # other requests (0 disables it), and the maximum number of requests
+    group_window = 0
+    group_size = 20
+
+    def __init__(self, *args, **kw):
+        super(Database, self).__init__(*args, **kw)
+        self.after_commit = []
+        # The requests waiting for the group commit [(author, msg, result)]
+        self.group = []
+        self.committing = []
+        # The value of "changes" when the last request joined the group,
+        # and the handlers changed since then
+        self.group_changes = 0
+        self.touched = set()
+
+
+    def call_after_commit(self, callback, *args):
+        """The callback will be called once the current transaction is
+        committed (not if it is aborted).
+        """
+        self.after_commit.append((callback, args))
+
+
+    def init_context(self, user=None, username=None, email=None,
+                     commit_at_exit=True, read_only=False):
         from ikaaro.context import CMSContext
         root = self.get_resource('/', soft=True)
         cls = root.context_cls if root else CMSContext
         return ContextManager(cls,
             database=self, user=user,
             username=username, email=email,
-            commit_at_exit=commit_at_exit)
+            commit_at_exit=commit_at_exit, read_only=read_only)
+
+
+    def save_changes(self, *args, **kw):
+        context = get_context()
+        # Nothing to save but the changes of the group
+        if self.group and not self.has_own_changes():
+            if not getattr(context, 'group_flush', False):
+                return
+        # A shared (read-only) context must not write: other readers are
+        # using the database at the same time
+        if context and context.read_only and self.has_changed:
+            msg = 'Warning: changes made by a read-only request are aborted'
+            log_warning('%s (%s %s)' % (msg, context.method, context.uri),
+                        domain='ikaaro')
+            self.abort_changes()
+            return
+        # Group commit
+        if (self.group_window and self.has_changed and
+            getattr(context, 'group_commit', None) is True and
+            not getattr(context, 'group_flush', False)):
+            self.join_group(context)
+            if len(self.group) < self.group_size:
+                return
+            context.group_flush = True
+        has_changed = self.has_changed
+        group, self.group = self.group, []
+        self.committing = group
+        proxy = super(Database, self)
+        try:
+            proxy.save_changes(*args, **kw)
+        except Exception, e:
+            for author, msg, result in group:
+                result.set_exception(e)
+            raise
+        finally:
+            self.committing = []
+            self.group_changes = self.changes
+            self.touched = set()
+            # Do not keep the resources (and their handlers) from one
+            # transaction to the next
+            resources = self.get_resources_map()
+            if resources:
+                resources.clear()
+        for author, msg, result in group:
+            result.set(True)
+        # Tell the read-only servers there is a new commit
+        if has_changed:
+            self.generation += 1
+            with open('%s/commit' % self.path, 'w') as f:
+                f.write(repr(time()))
+            # The permissions checked so far may have changed
+            if context:
+                context.permissions.clear()
+        # Callbacks
+        after_commit, self.after_commit = self.after_commit, []
+        for callback, args in after_commit:
+            try:
+                callback(*args)
+            except Exception:
+                log_error('Error after commit', domain='ikaaro')
+
+
+    def load_onchange_index(self):
+        index = OnchangeIndex()
+        index.load(self)
+        self.onchange_index = index
+
+
+    def get_onchange_reindex(self, paths):
+        """Return the resources that depend on the given ones (their
+        onchange_reindex field has one of the given paths).
+        """
+        if self.onchange_index is not None:
+            return self.onchange_index.get_sources(paths)
+
+        sources = set()
+        # XXX we regroup items by 200 because Xapian is slow
+        # when there's too much items in OrQuery
+        paths = list(paths)
+        for n in range(0, len(paths), 200):
+            query = [ PhraseQuery('onchange_reindex', x)
+                      for x in paths[n:n+200] ]
+            search = self.search(OrQuery(*query))
+            for brain in search.get_documents():
+                sources.add(brain.abspath)
+        return sources
+
+
+    def touch_handler(self, key, handler=None):
+        self.changes += 1
+        self.touched.add(self.normalize_key(key))
+        return super(Database, self).touch_handler(key, handler)
+
+
+    def set_handler(self, key, handler):
+        self.changes += 1
+        self.touched.add(self.normalize_key(key))
+        return super(Database, self).set_handler(key, handler)
+
+
+    def del_handler(self, key):
+        self.changes += 1
+        return super(Database, self).del_handler(key)
+
+
+    def move_handler(self, source, target):
+        self.changes += 1
+        self.touched.add(self.normalize_key(target))
+        return super(Database, self).move_handler(source, target)
+
+
+    def copy_handler(self, source, target, exclude_patterns=None):
+        self.changes += 1
+        self.touched.add(self.normalize_key(target))
+        proxy = super(Database, self)
+        return proxy.copy_handler(source, target, exclude_patterns)
+
+
+    def remove_resource(self, resource):
+        super(Database, self).remove_resource(resource)
+        self.forget_resources(resource.abspath)
+
+
+    def add_resource(self, resource):
+        super(Database, self).add_resource(resource)
+        self.forget_resources(resource.abspath)
+
+
+    def move_resource(self, source, new_path):
+        super(Database, self).move_resource(source, new_path)
+        self.forget_resources(source.abspath)
+        self.forget_resources(new_path)
+
+
+    def abort_changes(self):
+        # The changes of the group are kept if the current transaction did
+        # not change anything (else they are lost too)
+        if self.group and not self.has_own_changes():
+            return
+        self.after_commit = []
+        self.changes += 1
+        self.group_changes = self.changes
+        self.touched = set()
+        group, self.group = self.group, []
+        error = RuntimeError('the changes of the group commit were aborted')
+        for author, msg, result in group:
+            result.set_exception(error)
+        resources = self.get_resources_map()
+        if resources:
+            resources.clear()
+        proxy = super(Database, self)
+        return proxy.abort_changes()
+
+
+    def _abort_changes(self):
+        # This is called by save_changes too, when the commit fails: the
+        # callbacks of the transaction are dropped, and the caches may have
+        # been filled from the changes aborted
+        self.after_commit = []
+        paths = set(self.resources_old2new) | set(self.resources_new2old)
+        invalidate_caches(paths)
+        return super(Database, self)._abort_changes()
 
 
     def close(self):
+        # Save the changes of the group (if the current transaction changed
+        # something, they are aborted with it)
+        context = get_context()
+        if self.group and context is None:
+            self.flush_group()
+        elif self.group and not self.has_own_changes():
+            context.group_flush = True
+            try:
+                self.save_changes()
+            finally:
+                context.group_flush = False
         # Close
         proxy = super(Database, self)
         return proxy.close()
 
 
+    ########################################################################
+    # Group commit
+    ########################################################################
+    def has_own_changes(self):
+        """Tells whether the current transaction changed something since
+        the last request joined the group.
+        """
+        return self.changes != self.group_changes
+
+
+    def join_group(self, context):
+        """Keep the changes of the request, to be saved along with those of
+        the other requests that come within "group_window" seconds. The
+        request waits for the commit before sending the response (see
+        context.group_commit).
+        """
+        self.update_mtime(context, self.touched)
+        git_author, git_msg = self.get_commit_info(context)
+        result = AsyncResult()
+        self.group.append((git_author, git_msg, result))
+        context.group_commit = result
+        self.group_changes = self.changes
+        self.touched = set()
+        if len(self.group) == 1:
+            spawn_later(self.group_window, self.flush_group)
+
+
+    def flush_group(self):
+        """Save the changes of the group.
+        """
+        if not self.group:
+            return
+        with self.init_context(commit_at_exit=False) as context:
+            context.group_flush = True
+            try:
+                self.save_changes()
+            except Exception:
+                log_error('Group commit failed', domain='ikaaro')
+
+
+    def get_group_commit_info(self, context):
+        """Return the author and message of a group commit: the author and
+        message of every request are in the body of the message.
+        """
+        members = [ (author, msg) for author, msg, result in self.committing ]
+        if not getattr(context, 'group_flush', False):
+            members.append(self.get_commit_info(context))
+        authors = set([ author for author, msg in members ])
+        if len(authors) == 1:
+            git_author = members[0][0]
+        else:
+            git_author = ('nobody', 'nobody')
+        lines = [ '%s <%s>: %s' % (author[0], author[1], msg or 'no comment')
+                  for author, msg in members ]
+        git_msg = 'Group commit of %d requests\n\n%s' % (len(members),
+                                                           '\n'.join(lines))
+        return git_author, git_msg
+
+
+    ########################################################################
+    # Commit
+    ########################################################################
+    def update_mtime(self, context, keys=None):
+        """Set the mtime and last author of the changed resources, only of
+        those with the given metadata handlers if any.
+        """
+        if not context.set_mtime:
+            return
+        root = self.get_resource('/')
+        user = context.user
+        userid = user.name if user else None
+        for path in self.resources_new2old:
+            resource = root.get_resource(path)
+            handler = resource.metadata
+            if keys is not None and handler.key not in keys:
+                continue
+            if handler.dirty:
+                # Save mtime, only if there's really changes
+                # (if we reindex resource, no need to update mtime)
+                handler.set_property('mtime', context.timestamp)
+                handler.set_property('last_author', userid)
+
+
+    def get_commit_info(self, context):
+        """Return the author and the message of the commit.
+        """
+        user = context.user
+        if user:
+            user_email = user.get_value('email')
+            git_author = (user.name, user_email or 'nobody')
+        else:
+            git_author = ('nobody', 'nobody')
+
+        git_msg = getattr(context, 'git_message', None)
+        if not git_msg:
+            if context.method and context.uri:
+                git_msg = "%s %s" % (context.method, context.uri)
+
+                action = getattr(context, 'form_action', None)
+                if action:
+                    git_msg += " action: %s" % action
+        else:
+            git_msg = git_msg.encode('utf-8')
+        return git_author, git_msg
+
+
+    def get_catalog_digests(self, paths):
+        """Return the digests stored in the catalog for the given paths
+        (see get_catalog_digest).
+        """
+        digests = {}
+        for n in range(0, len(paths), 200):
+            query = [ PhraseQuery('abspath', x) for x in paths[n:n+200] ]
+            search = self.search(OrQuery(*query))
+            for brain in search.get_documents():
+                try:
+                    digests[brain.abspath] = brain.catalog_digest
+                except AttributeError:
+                    # Catalog made before the digests
+                    pass
+        return digests
+
+
     def _before_commit(self):
+        from ikaaro.resource_ import IndexingCache, get_catalog_digest
         root = self.get_resource('/')
         context = get_context()
         if context.database != self:
@@ -141,41 +660,25 @@ class Database(RWDatabase):
             resource._on_move_resource(source)
 
         # 2. Find out resources to re-index because they depend on another
-        # resource that changed
+        # resource that changed (every round only searches the paths found
+        # in the previous one)
         to_reindex = set()
-        aux = set()
-        aux2 = set(self.resources_old2new.keys())
-        while len(aux) != len(aux2):
-            aux = set(aux2)
-            # XXX we regroup items by 200 because Xapian is slow
-            # when there's too much items in OrQuery
-            l_aux = list(aux)
-            for sub_aux in [l_aux[n:n+200] for n in range(0, len(l_aux), 200)]:
-                query = [ PhraseQuery('onchange_reindex', x) for x in sub_aux ]
-                query = OrQuery(*query)
-                search = self.search(query)
-                for brain in search.get_documents():
-                    path = brain.abspath
-                    aux2.add(path)
-                    to_reindex.add(path)
+        seen = set(self.resources_old2new.keys())
+        frontier = seen
+        while frontier:
+            sources = self.get_onchange_reindex(frontier)
+            to_reindex.update(sources)
+            frontier = sources - seen
+            seen.update(frontier)
 
         # 3. Documents to unindex (the update_links methods calls
         # 'change_resource' which may modify the resources_old2new dictionary)
         docs_to_unindex = self.resources_old2new.keys()
         self.resources_old2new.clear()
 
-        # 4. Update mtime/last_author
-        user = context.user
-        userid = user.name if user else None
-        for path in self.resources_new2old:
-            if context.set_mtime:
-                resource = root.get_resource(path)
-                handler = resource.metadata
-                if handler.dirty:
-                    # Save mtime, only if there's really changes
-                    # (if we reindex resource, no need to update mtime)
-                    handler.set_property('mtime', context.timestamp)
-                    handler.set_property('last_author', userid)
+        # 4. Update mtime/last_author (with a group commit, it was done when
+        # every request joined the group)
+        self.update_mtime(context, self.touched if self.committing else None)
         # Remove from to_reindex if resource has been deleted
         to_reindex = to_reindex - set(docs_to_unindex)
         # 5. Index
@@ -183,32 +686,46 @@ class Database(RWDatabase):
         docs_to_index = set(docs_to_index) | to_reindex
         docs_to_unindex = list(set(docs_to_unindex) - docs_to_index)
         docs_to_index = list(docs_to_index)
+        # Clear the caches that depend on the changed resources
+        invalidate_caches(docs_to_index + docs_to_unindex)
         aux = []
-        for path in docs_to_index:
-            resource = root.get_resource(path, soft=True)
-            if resource:
-                values = resource.get_catalog_values()
-                aux.append((resource, values))
+        context.indexing = IndexingCache(root)
+        try:
+            for path in docs_to_index:
+                resource = root.get_resource(path, soft=True)
+                if resource:
+                    values = resource.get_catalog_values()
+                    aux.append((resource, values))
+        finally:
+            context.indexing = None
         docs_to_index = aux
         self.resources_new2old.clear()
+        # Update the index of the dependencies, once committed
+        if self.onchange_index is not None:
+            indexed = [ (y['abspath'], y['onchange_reindex'])
+                        for x, y in docs_to_index ]
+            self.call_after_commit(self.onchange_index.update, indexed,
+                                   docs_to_unindex)
+        # Skip the documents that did not change since they were indexed
+        paths = [ y['abspath'] for x, y in docs_to_index ]
+        digests = self.get_catalog_digests(paths)
+        aux = []
+        for resource, values in docs_to_index:
+            digest = get_catalog_digest(values)
+            if digests.get(values['abspath']) != digest:
+                values['catalog_digest'] = digest
+                aux.append((resource, values))
+        if docs_to_index:
+            msg = 'Commit: %d documents indexed, %d skipped'
+            skipped = len(docs_to_index) - len(aux)
+            log_info(msg % (len(aux), skipped), domain='ikaaro')
+        docs_to_index = aux
 
         # 6. Find out commit author & message
-        if user:
-            user_email = user.get_value('email')
-            git_author = (userid, user_email or 'nobody')
-        else:
-            git_author = ('nobody', 'nobody')
-
-        git_msg = getattr(context, 'git_message', None)
-        if not git_msg:
-            if context.method and context.uri:
-                git_msg = "%s %s" % (context.method, context.uri)
-
-                action = getattr(context, 'form_action', None)
-                if action:
-                    git_msg += " action: %s" % action
+        if self.committing:
+            git_author, git_msg = self.get_group_commit_info(context)
         else:
-            git_msg = git_msg.encode('utf-8')
+            git_author, git_msg = self.get_commit_info(context)
 
         # Ok
         git_date = context.fix_tzinfo(context.timestamp)
@@ -223,6 +740,17 @@ class Database(RWDatabase):
 
 
 
+def get_commit_stamp(database):
+    """Return the stamp written by the read-write server on every commit.
+    """
+    try:
+        with open('%s/commit' % database.path) as f:
+            return f.read()
+    except IOError:
+        return None
+
+
+
 def get_database(path, size_min, size_max, read_only=False, backend='git'):
     if read_only is True:
         return RODatabase(path, size_min, size_max, backend=backend)
@@ -653,6 +653,17 @@ class File_Field(Field):
                 cls = get_handler_class_by_mimetype(mimetype)
             return cls(string=value)
 
+        # An uploaded file (see ikaaro.web.multipart)
+        if hasattr(value, 'read'):
+            cls = self.class_handler
+            if cls is None:
+                mimetype = magic_from_buffer(value.read(1024))
+                value.seek(0)
+                cls = get_handler_class_by_mimetype(mimetype)
+            handler = cls()
+            handler.load_state_from_file(value)
+            return handler
+
         return value
 
 
@@ -43,6 +43,7 @@ from file_views import Image_View, Video_View, Archive_View
 from file_views import Flash_View
 from resource_ import DBResource
 from resource_views import DBResource_GetImage
+from thumbnails import thumbnails
 
 
 
@@ -160,6 +161,31 @@ class Image(File):
                 min(ysize, max_height or ysize))
             handler.load_state_from_string(thumb)
 
+
+    def update_resource(self, context):
+        super(Image, self).update_resource(context)
+        handler = self.get_value('data')
+        if handler is None or not handler.dirty:
+            return
+        # The image changed
+        thumbnails.invalidate(handler.key)
+        server = context.server
+        if not server or not server.thumbnail_sizes:
+            return
+        if getattr(handler, 'get_thumbnail', None):
+            context.database.call_after_commit(self.make_thumbnails,
+                                               server.thumbnail_sizes)
+
+
+    def make_thumbnails(self, sizes):
+        """Make the thumbnails of the given sizes, like asked by the "thumb"
+        view (without the "lossy" and "fit" parameters).
+        """
+        handler = self.get_value('data')
+        format = handler.get_mimetype().split('/')[1]
+        for width, height in sizes:
+            thumbnails.get_thumbnail(handler, width, height, format)
+
     # Views
     thumb = DBResource_GetImage(field_name='data')
     view = Image_View()
@@ -76,6 +76,7 @@ class File_View(STLView):
     access = 'is_allowed_to_view'
     title = MSG(u'Download')
     icon = 'view.png'
+    cacheable = True
     template = '/ui/ikaaro/file/download_form.xml'
 
 
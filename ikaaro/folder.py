@@ -184,6 +184,8 @@ class Folder(DBResource):
             for handler in [r.metadata] + r.get_fields_handlers():
                 if database.has_handler(handler.key):
                     database.del_handler(handler.key)
+        # The resources loaded meanwhile are gone
+        database.forget_resources(path)
 
 
     def _get_names(self):
@@ -203,7 +205,11 @@ class Folder(DBResource):
         if type(name) is not str:
             raise TypeError, 'expected string, got %s' % repr(name)
 
-        # Web Pages are first class citizens
+        # Web Pages are first class citizens (and read in memory, the
+        # uploaded files may be given as file objects)
+        if mimetype in ('text/html', 'application/xhtml+xml'):
+            if hasattr(body, 'read'):
+                body = body.read()
         if mimetype == 'text/html':
             body = tidy_html(body)
             class_id = 'webpage'
@@ -462,6 +468,9 @@ class Folder(DBResource):
             target_path_child = target_path.resolve2(child.name)
             self.move_resource(source_path_child, target_path_child,
                 check_if_authorized=False)
+        # The resources loaded meanwhile are gone
+        database.forget_resources(source.abspath)
+        database.forget_resources(new_path)
 
 
 
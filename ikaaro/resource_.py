@@ -21,6 +21,7 @@
 
 # Import from the Standard Library
 from datetime import datetime
+from hashlib import sha1
 from pickle import dumps
 from uuid import uuid4
 
@@ -59,6 +60,79 @@ from widgets import CheckboxWidget
 
 
 
+def copy_value(value):
+    """The values are cached by the resource, the lists are copied so the
+    caller may change them.
+    """
+    if type(value) is list:
+        return list(value)
+    return value
+
+
+
+def dump_catalog_value(value):
+    if type(value) is dict:
+        items = [ '%r:%s' % (key, dump_catalog_value(value[key]))
+                  for key in sorted(value) ]
+        return '{%s}' % ','.join(items)
+    if type(value) in (list, tuple):
+        return '[%s]' % ','.join([ dump_catalog_value(x) for x in value ])
+    if type(value) in (set, frozenset):
+        return dump_catalog_value(sorted(value))
+    return repr(value)
+
+
+def get_catalog_digest(values):
+    """Return the digest of the values of a document of the catalog, stored
+    in the "catalog_digest" field, so a document is not indexed again when
+    its values did not change. The multilingual values (dictionaries) are
+    sorted by language.
+    """
+    digest = sha1()
+    for name in sorted(values):
+        if name != 'catalog_digest':
+            value = dump_catalog_value(values[name])
+            digest.update('%s=%s\n' % (name, value))
+    return digest.hexdigest()
+
+
+
+class IndexingCache(object):
+    """What the resources indexed together (by a commit, or when the catalog
+    is made again) have in common: the languages of the website, the access
+    rules, and by class the fields to index and the base classes. It is
+    kept by the context while indexing (context.indexing).
+    """
+
+    def __init__(self, root):
+        self.languages = root.get_value('website_languages')
+        self.access = root.get_resource('/config/access', soft=True)
+        # {class: [(name, field), ...]}
+        self.fields = {}
+        # {class: [class_id, ...]}
+        self.base_classes = {}
+
+
+    def get_fields(self, resource):
+        cls = resource.__class__
+        fields = self.fields.get(cls)
+        if fields is None:
+            fields = [ (name, field) for name, field in cls.get_fields()
+                       if field.indexed or field.stored ]
+            self.fields[cls] = fields
+        return fields
+
+
+    def get_base_classes(self, resource):
+        cls = resource.__class__
+        base_classes = self.base_classes.get(cls)
+        if base_classes is None:
+            base_classes = resource.get_base_classes()
+            self.base_classes[cls] = base_classes
+        return list(base_classes)
+
+
+
 class Share_Field(SelectAbspath_Field):
 
     title = MSG(u'Share')
@@ -84,6 +158,7 @@ class DBResource(Resource):
     # Internal
     _values = {}
     _values_title = {}
+    _values_changes = None
     _metadata = None
     _brain = None
 
@@ -327,11 +402,10 @@ class DBResource(Resource):
         if field.obsolete:
             msg = 'field {name} is obsolete on {class_id}'
             log_warning(msg.format(name=name, class_id=self.class_id))
-        # TODO: Use decorator for cache
-        # TODO: Reactivate when ready
-        #cache_key = (name, language)
-        #if self._values.has_key(cache_key):
-        #    return self._values[cache_key]
+        cache = self.get_values_cache()
+        cache_key = (name, language)
+        if cache_key in cache:
+            return copy_value(cache[cache_key])
         if self._brain and field.stored and not is_prototype(field.datatype, Decimal):
             try:
                 value = self.get_value_from_brain(name, language)
@@ -344,8 +418,20 @@ class DBResource(Resource):
                 value = field.get_value(self, name, language)
         else:
             value = field.get_value(self, name, language)
-        #self._values[cache_key] = value
-        return value
+        cache[cache_key] = value
+        return copy_value(value)
+
+
+    def get_values_cache(self):
+        """Return the cache of the values, emptied when a handler of the
+        database changes (or the changes are aborted).
+        """
+        changes = getattr(self.database, 'changes', 0)
+        if self._values_changes != changes:
+            self._values = {}
+            self._values_title = {}
+            self._values_changes = changes
+        return self._values
 
 
     def get_value_from_brain(self, name, language=None):
@@ -378,28 +464,36 @@ class DBResource(Resource):
         return field.set_value(self, name, value, language, **kw)
 
 
-    def clear_cache(self, name, language):
-        cache_key = (name, language)
-        if self._values.get(cache_key):
-            del self._values[cache_key]
-        if self._values_title.get(cache_key):
-            del self._values_title[cache_key]
+    def clear_cache(self, name=None, language=None):
+        """Remove from the cache the values of the given field, all the
+        languages if no language is given, or all the values if no field
+        is given. The value in the negotiated language (None) is always
+        removed.
+        """
+        if name is None:
+            self._values = {}
+            self._values_title = {}
+        else:
+            for cache in self._values, self._values_title:
+                for key in cache.keys():
+                    if key[0] == name and key[1] in (None, language):
+                        del cache[key]
+                    elif key[0] == name and language is None:
+                        del cache[key]
         self._brain = None
 
 
     def get_value_title(self, name, language=None, mode=None):
-        # TODO: Use decorator for cache
-        # TODO: Reactivate when ready
-        #cache_key = (name, language)
-        #if (self._values_title.has_key(cache_key) and
-        #    self._values_title[cache_key].has_key(mode)):
-        #    return self._values_title[cache_key][mode]
         field = self.get_field(name)
         if field is None:
             return None
+        self.get_values_cache()
+        cache_key = (name, language, mode)
+        if cache_key in self._values_title:
+            return copy_value(self._values_title[cache_key])
         value_title = field.get_value_title(self, name, language, mode)
-        #self._values_title.setdefault(cache_key, {})[mode] = value_title
-        return value_title
+        self._values_title[cache_key] = value_title
+        return copy_value(value_title)
 
 
     def get_brain_value(self, name):
@@ -555,14 +649,20 @@ class DBResource(Resource):
         return None
 
 
+    def get_indexing_cache(self):
+        context = get_context()
+        indexing = getattr(context, 'indexing', None)
+        if indexing is None:
+            return IndexingCache(self.get_root())
+        return indexing
+
+
     def get_catalog_values(self):
         values = {}
+        indexing = self.get_indexing_cache()
         # Step 1. Automatically index fields
-        root = self.get_root()
-        languages = root.get_value('website_languages')
-        for name, field in self.get_fields():
-            if not field.indexed and not field.stored:
-                continue
+        languages = indexing.languages
+        for name, field in indexing.get_fields(self):
             if field.multilingual:
                 value = {}
                 for language in languages:
@@ -581,12 +681,16 @@ class DBResource(Resource):
         values['name'] = self.name
         # Class related fields
         values['format'] = self.metadata.format
-        values['base_classes'] = self.get_base_classes()
+        values['base_classes'] = indexing.get_base_classes(self)
         values['class_version'] = class_version_to_date(self.metadata.version)
         # Links to other resources
         values['owner'] = self.get_owner()
         values['share'] = self.get_share()
-        values['links'] = list(self.get_links())
+        access = indexing.access
+        if access is not None:
+            values['allowed_viewers'] = access.get_allowed_viewers(
+                self, values['owner'], values['share'])
+        values['links'] = sorted(self.get_links())
         values['onchange_reindex'] = self.get_onchange_reindex()
         # Full text indexation (not available in icms-init.py FIXME)
         context = get_context()
@@ -683,7 +787,11 @@ class DBResource(Resource):
 
     def get_links(self):
         # Automatically from the fields
-        languages = self.get_resource('/').get_value('website_languages')
+        indexing = getattr(get_context(), 'indexing', None)
+        if indexing is None:
+            languages = self.get_resource('/').get_value('website_languages')
+        else:
+            languages = indexing.languages
         links = set()
         for field_name in self.fields:
             field = self.get_field(field_name)
@@ -910,8 +1018,12 @@ register_field('class_version', Date(indexed=True, stored=True))
 # Referential integrity
 register_field('links', String(multiple=True, indexed=True))
 register_field('onchange_reindex', String(multiple=True, indexed=True))
+# Access control
+register_field('allowed_viewers', String(multiple=True, indexed=True))
 # Full text search
 register_field('text', Unicode(indexed=True))
 # Time events
 register_field('next_time_event', DateTime(stored=True))
 register_field('next_time_event_payload', String(stored=True))
+# To skip the documents that did not change (see get_catalog_digest)
+register_field('catalog_digest', String(stored=True))
@@ -19,6 +19,10 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+# Import from the Standard Library
+from cStringIO import StringIO
+from uuid import uuid4
+
 # Import from itools
 from itools.core import guess_extension, merge_dicts
 from itools.database import OrQuery, PhraseQuery
@@ -39,6 +43,8 @@ from buttons import Remove_Button
 from emails import send_email
 from exceptions import ConsistencyError
 from messages import MSG_LOGIN_WRONG_NAME_OR_PASSWORD
+from thumbnails import thumbnails
+from utils import check_conditional_get, get_byte_ranges, get_etag
 
 
 
@@ -67,6 +73,55 @@ class DBResource_Remove(AutoForm):
 
 
 
+class FileRanges(object):
+    """Read the given byte ranges of the file, with the headers of the parts
+    for a multipart/byteranges body. It is file-like (not a generator, which
+    would be taken for an XML stream), so it is streamed like a file.
+    """
+
+    def __init__(self, file, ranges, headers=None, closing=None):
+        self.file = file
+        # The parts: strings, or (start, end) ranges of the file
+        self.parts = []
+        for i, (start, end) in enumerate(ranges):
+            if headers:
+                self.parts.append(headers[i])
+            self.parts.append((start, end))
+        if closing:
+            self.parts.append(closing)
+
+
+    def read(self, size=-1):
+        parts = self.parts
+        chunks = []
+        while parts and size != 0:
+            part = parts.pop(0)
+            if type(part) is str:
+                if 0 < size < len(part):
+                    parts.insert(0, part[size:])
+                    part = part[:size]
+                data = part
+            else:
+                start, end = part
+                n = end - start + 1
+                if 0 < size < n:
+                    n = size
+                    parts.insert(0, (start + n, end))
+                self.file.seek(start)
+                data = self.file.read(n)
+                if not data:
+                    continue
+            chunks.append(data)
+            if size > 0:
+                size -= len(data)
+        return ''.join(chunks)
+
+
+    def close(self):
+        self.file.close()
+
+
+
 class DBResource_GetFile(BaseView):
 
     access = 'is_allowed_to_view'
@@ -117,6 +172,12 @@ class DBResource_GetFile(BaseView):
         language = context.query['language']
         field_name = self.get_field_name(context)
         handler = self.get_handler(resource, field_name, language)
+        if handler is None:
+            raise NotFound
+        # 304 Not Modified
+        mtime = handler.get_mtime()
+        etag = get_etag(handler.key, mtime)
+        check_conditional_get(context, etag, mtime)
         # Content-Type
         content_type = self.get_content_type(handler)
         context.set_content_type(content_type)
@@ -124,8 +185,66 @@ class DBResource_GetFile(BaseView):
         disposition = 'attachment'
         filename = self.get_filename(handler, field_name, resource)
         context.set_content_disposition(disposition, filename)
-        # Ok
-        return handler.to_str()
+        # Ok: stream the file from the disk, unless it has been changed by
+        # this transaction
+        context.set_header('Accept-Ranges', 'bytes')
+        body = None
+        if handler.dirty is None:
+            fs = handler.database.fs
+            try:
+                body = fs.open(handler.key)
+                size = fs.get_size(handler.key)
+            except (IOError, OSError):
+                body = None
+        if body is None:
+            body = handler.to_str()
+            size = len(body)
+
+        # Range
+        ranges = get_byte_ranges(context.environ.get('HTTP_RANGE'), size)
+        if ranges is None:
+            return body
+        if_range = context.environ.get('HTTP_IF_RANGE')
+        if if_range:
+            last_modified = dict(context.header_response).get('Last-Modified')
+            if if_range not in (etag, last_modified):
+                return body
+        if type(body) is str:
+            body = StringIO(body)
+        return self.get_ranges_body(context, body, size, ranges,
+                                    content_type)
+
+
+    def get_ranges_body(self, context, body, size, ranges, content_type):
+        # 416 Requested Range Not Satisfiable
+        if not ranges:
+            body.close()
+            context.status = 416
+            context._set_header('Content-Range', 'bytes */%s' % size)
+            return ''
+
+        # 206 Partial Content
+        context.status = 206
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            context._set_header('Content-Range',
+                                'bytes %s-%s/%s' % (start, end, size))
+            context._set_header('Content-Length', str(end - start + 1))
+            return FileRanges(body, ranges)
+
+        # Multiple ranges
+        boundary = uuid4().hex
+        context.set_content_type('multipart/byteranges', boundary=boundary)
+        headers = [
+            '\r\n--%s\r\nContent-Type: %s\r\n'
+            'Content-Range: bytes %s-%s/%s\r\n\r\n'
+            % (boundary, content_type, a, b, size)
+            for a, b in ranges ]
+        closing = '\r\n--%s--\r\n' % boundary
+        length = sum([ len(x) for x in headers ]) + len(closing)
+        length += sum([ b - a + 1 for a, b in ranges ])
+        context._set_header('Content-Length', str(length))
+        return FileRanges(body, ranges, headers, closing)
 
 
 
@@ -144,17 +263,27 @@ class DBResource_GetImage(DBResource_GetFile):
         field_name = self.get_field_name(context)
         language = context.query['language']
         handler = self.get_handler(resource, field_name, language)
+        if handler is None:
+            raise NotFound
+
+        # 304 Not Modified (one entity tag by size)
+        query = context.query
+        fit = query['fit']
+        lossy = query['lossy']
+        mtime = handler.get_mtime()
+        etag = get_etag(handler.key, mtime, query['width'], query['height'],
+                        fit, lossy)
+        check_conditional_get(context, etag, mtime)
 
         image_width, image_height = handler.get_size()
-        fit = context.query['fit']
-        lossy = context.query['lossy']
-        width = context.query['width'] or image_width
-        height = context.query['height'] or image_height
+        width = query['width'] or image_width
+        height = query['height'] or image_height
 
         format = 'jpeg'
         if lossy is False:
             format = handler.get_mimetype().split('/')[1]
-        data, format = handler.get_thumbnail(width, height, format, fit)
+        data, format = thumbnails.get_thumbnail(handler, width, height, format,
+                                                fit)
         if data is None:
             default = context.get_template('/ui/ikaaro/icons/48x48/image.png')
             data = default.to_str()
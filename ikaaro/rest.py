@@ -28,7 +28,7 @@ from itools.web import BaseView
 # Import from ikaaro
 from fields import Metadata_Field, File_Field
 from resource_views import LoginView
-from utils import get_base_path_query
+from utils import check_conditional_get, get_base_path_query, get_etag
 
 
 ###########################################################################
@@ -183,12 +183,16 @@ class Rest_Read(Rest_BaseView):
             value = field_to_json(resource, field_name)
             if value is not None:
                 representation[field_name] = value
+        entity = self.return_json(representation, context)
+
+        # 304 Not Modified
+        # The files and the computed values do not change the mtime of the
+        # metadata, so the entity tag is made from the JSON itself.
+        etag = get_etag(resource.abspath, entity)
+        check_conditional_get(context, etag)
 
-        # Set last modification time
-        mtime = resource.get_value('mtime')
-        context.set_header('Last-Modified', mtime)
         # Ok
-        return self.return_json(representation, context)
+        return entity
 
 
 class Rest_Create(Rest_BaseView):
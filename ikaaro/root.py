@@ -497,6 +497,14 @@ class Root(Folder):
         return access.has_permission(user, permission, resource, class_id)
 
 
+    def has_permissions(self, user, permission, resources, class_id=None):
+        """Check the permission on several resources at once, returns the
+        set of the abspaths of the resources allowed.
+        """
+        access = self.get_resource('config/access')
+        return access.has_permissions(user, permission, resources, class_id)
+
+
     def is_allowed_to_view(self, user, resource):
         return self.has_permission(user, 'view', resource)
 
@@ -340,7 +340,7 @@ class UpdateDocs(AutoForm):
         # 2. Extract
         filename, mimetype, body = form['file']
         cls = get_handler_class_by_mimetype(mimetype)
-        handler = cls(string=body)
+        handler = cls(string=body.read())
         docs.extract_archive(handler, language, filter, postproc, True)
 
         # Ok
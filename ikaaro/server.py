@@ -28,8 +28,9 @@ from time import strftime
 import inspect
 import json
 import pickle
-from os import fdopen, getpgid, getpid, kill, mkdir, remove
-from os.path import join
+from zlib import crc32
+from os import _exit, fdopen, getpgid, getpid, kill, mkdir, remove
+from os.path import exists, join
 from psutil import pid_exists
 import sys
 from time import time
@@ -43,7 +44,10 @@ from wsgiref.util import setup_testing_defaults
 
 # Import from gevent
 from gevent.pywsgi import WSGIServer, WSGIHandler
-from gevent import signal as gevent_signal
+from gevent import fork, signal as gevent_signal
+from gevent.os import waitpid
+from gevent.socket import socket, AF_INET, AF_UNIX, SOCK_STREAM
+from gevent.socket import SOL_SOCKET, SO_REUSEADDR
 
 # Import from itools
 from itools.core import become_daemon, vmsize
@@ -65,14 +69,21 @@ from itools.web.dispatcher import URIDispatcher
 from itools.web.server import AccessLogger
 
 # Import from ikaaro
-from ikaaro.web.wsgi import application
+from ikaaro.web.wsgi import application, compression, page_cache
+from ikaaro.web.wsgi import worker_application
 
 # Import from ikaaro.web
+from assets import static_assets
+from cache import clear_caches, get_caches_stats
+from database import enable_greenlet_contexts, get_commit_stamp
 from database import get_database
 from datatypes import ExpireValue
+from resource_ import IndexingCache, get_catalog_digest
 from root import Root
-from views import CachedStaticView
+from views import BundleView, CachedStaticView
 from skins import skin_registry
+from templates import template_registry
+from thumbnails import thumbnails
 from views import IkaaroStaticView
 
 
@@ -137,6 +148,51 @@ session-timeout = 0
 database-size = 19500:20500
 database-readonly = 0
 
+# The "database-lock" variable defines how requests share the database. With
+# "exclusive" (the default) requests are handled one at a time. With
+# "readers" the GET and HEAD requests are handled concurrently, and only the
+# other requests (POST, PUT, ...) take an exclusive lock on the database.
+#
+database-lock = exclusive
+
+# The "page-cache" variable defines the number of seconds the pages served to
+# anonymous users are kept in the cache (only the views declared cacheable).
+# If zero (the default) the cache is not used. Once expired a page is still
+# served for "page-cache-stale" seconds, while it is computed again. The
+# "page-cache-size" variable defines the maximum number of pages in the cache.
+# The pages are removed from the cache when the resources they depend on
+# change.
+#
+page-cache = 0
+page-cache-stale = 60
+page-cache-size = 1000
+
+# The "group-commit" variable defines the number of milliseconds a write
+# request waits for other requests, to save their changes with a single
+# commit. The response is sent once the changes are saved. If zero (the
+# default) every request makes its own commit. The "group-commit-size"
+# variable defines the maximum number of requests in a commit.
+#
+group-commit = 0
+group-commit-size = 20
+
+# The responses are compressed (gzip) if the client accepts it. The
+# "gzip-level" variable defines the compression level, from 1 (fastest) to 9
+# (smallest), 0 disables the compression (the default is 6). Only the
+# responses bigger than "gzip-min-size" bytes (default 1024) and of the
+# content types listed by "gzip-types" are compressed.
+#
+gzip-level = 6
+gzip-min-size = 1024
+gzip-types = text/html text/plain text/css text/xml application/json application/javascript application/xml
+
+# The "onchange-index" variable, when set to 1, keeps in memory the
+# dependencies between the resources (the "onchange_reindex" field of the
+# catalog), to find out faster the resources to re-index on every commit.
+# It is loaded when the server starts (default is 0).
+#
+onchange-index = 0
+
 # The "index-text" variable defines whether the catalog must process full-text
 # indexing. It requires (much) more time and third-party applications.
 # To speed up catalog updates, set this option to 0 (default is 1).
@@ -154,6 +210,15 @@ accept-cors = 0
 #
 max-width =
 max-height =
+
+# The image thumbnails are cached in the "thumbnails" folder of the instance.
+# The "thumbnail-cache-size" variable defines its maximum size in megabytes
+# (0 disables the cache, the default is 500). The "thumbnail-sizes" variable
+# lists the sizes of the thumbnails made when an image is uploaded
+# (ie. thumbnail-sizes = 48x48 300x300).
+#
+thumbnail-cache-size = 500
+thumbnail-sizes =
 """)
 
 
@@ -213,6 +278,122 @@ def stop_server(target):
         kill(pid, SIGTERM)
 
 
+def make_listener(address, port=None):
+    """Return a listening socket, on the given unix socket path if there
+    is no port.
+    """
+    if port is None:
+        if exists(address):
+            remove(address)
+        listener = socket(AF_UNIX, SOCK_STREAM)
+        listener.bind(address)
+    else:
+        if address == '*':
+            address = ''
+        listener = socket(AF_INET, SOCK_STREAM)
+        listener.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        listener.bind((address, port))
+    listener.listen(256)
+    return listener
+
+
+def start_workers(target, workers, port=None, detach=False, profile=False):
+    """Pre-fork mode: start the given number of read-only worker processes
+    sharing the listening socket. They serve the GET and HEAD requests, the
+    other requests are forwarded to the read-write process (this process).
+    """
+    target = lfs.get_absolute_path(target)
+    # Check the server is not running
+    if get_pid('%s/pid' % target) is not None:
+        msg = '[%s] The Web Server is already running.' % target
+        log_warning(msg)
+        print(msg)
+        return False
+    # Find out the address to listen to
+    config = get_config(target)
+    address = config.get_value('listen-address').strip()
+    if not address:
+        raise ValueError('listen-address is missing from config.conf')
+    port = int(port) if port else config.get_value('listen-port')
+    if port is None:
+        raise ValueError('listen-port is missing from config.conf')
+    # Daemon mode
+    if detach:
+        become_daemon()
+
+    # Fork the read-only workers
+    listener = make_listener(address, port)
+    writer_address = '%s/writer.sock' % target
+    pids = []
+    try:
+        for i in range(workers):
+            pid = fork()
+            if pid == 0:
+                try:
+                    server = Server(target, read_only=True, port=port)
+                    server.start_worker(listener, writer_address)
+                except Exception:
+                    log_error('The worker failed', domain='ikaaro')
+                    _exit(1)
+                _exit(0)
+            pids.append(pid)
+        listener.close()
+        print('Listen %s:%d (%d read-only workers)' % (address, port,
+                                                        workers))
+
+        # The read-write process
+        server = Server(target, port=port)
+        def stop():
+            for pid in pids:
+                kill(pid, SIGTERM)
+            server.stop()
+        gevent_signal(SIGTERM, stop)
+        server.start(profile=profile, listener=make_listener(writer_address))
+    finally:
+        # Also if the read-write process failed to start (or to fork): the
+        # workers must not be left orphaned with the listener open
+        stop_workers(pids)
+    return True
+
+
+
+def stop_workers(pids):
+    """Stop the given worker processes and wait for them.
+    """
+    for pid in pids:
+        try:
+            kill(pid, SIGTERM)
+        except OSError:
+            pass
+    for pid in pids:
+        try:
+            waitpid(pid, 0)
+        except OSError:
+            pass
+
+
+
+def get_shard_resources(root, shard, jobs):
+    """Yield the resources of the given shard (from 0 to jobs - 1). The
+    resources are shared out by the hash of their path at the second level,
+    the sub-trees below are in the same shard. The root is in the first
+    shard.
+    """
+    if shard == 0:
+        yield root
+    for name in root._get_names():
+        container = root.get_resource(name)
+        if crc32(name) % jobs == shard:
+            yield container
+        for child_name in container._get_names():
+            path = '%s/%s' % (name, child_name)
+            if crc32(path) % jobs == shard:
+                child = container.get_resource(child_name)
+                for resource in child.traverse_resources():
+                    yield resource
+
+
+
 def get_root(database):
     metadata = database.get_handler('.metadata', cls=Metadata)
     cls = database.get_resource_class(metadata.format)
@@ -325,6 +506,12 @@ class Server(object):
     database = None
     session_timeout = timedelta(0)
     accept_cors = False
+    concurrent_readers = False
+    catalog_generation = None
+    writer_address = None
+    # The cron of the allowed viewers (see launch_viewers_index)
+    cron_launched = False
+    viewers_index_running = False
     dispatcher = URIDispatcher()
     wsgi_server = None
 
@@ -369,10 +556,43 @@ class Server(object):
         else:
             size_min = size_max = cache_size
         size_min, size_max = int(size_min), int(size_max)
+        self.cache_size = (size_min, size_max)
         read_only = read_only or config.get_value('database-readonly')
+        self.read_only = read_only
+        # Database lock
+        database_lock = config.get_value('database-lock')
+        if database_lock not in ('exclusive', 'readers'):
+            msg = 'configuration error, unexpected "%s" value for database-lock'
+            raise ValueError(msg % database_lock)
+        self.concurrent_readers = (database_lock == 'readers')
+        if self.concurrent_readers:
+            enable_greenlet_contexts()
+        # Thumbnails cache
+        size = config.get_value('thumbnail-cache-size')
+        thumbnails.configure('%s/thumbnails' % target, size * 1024 * 1024)
+        self.thumbnail_sizes = []
+        for size in config.get_value('thumbnail-sizes'):
+            width, height = size.split('x')
+            self.thumbnail_sizes.append((int(width), int(height)))
+        # Page cache
+        page_cache.configure(config.get_value('page-cache-size'),
+                             config.get_value('page-cache'),
+                             config.get_value('page-cache-stale'))
+        # Compression
+        compression.configure(config.get_value('gzip-level'),
+                              config.get_value('gzip-min-size'),
+                              config.get_value('gzip-types'))
         # Get database
         database = get_database(target, size_min, size_max, read_only)
         self.database = database
+        if not read_only and config.get_value('onchange-index'):
+            database.load_onchange_index()
+        # Group commit
+        group_commit = config.get_value('group-commit')
+        if not read_only and group_commit:
+            database.group_window = group_commit / 1000.0
+            database.group_size = config.get_value('group-commit-size')
+            enable_greenlet_contexts()
         # Find out the root class
         root = get_root(database)
         self.root = root
@@ -393,6 +613,8 @@ class Server(object):
         register_logger(logger, 'itools.web')
         # Useful the current uploads stats
         self.upload_stats = {}
+        # Catalog reopen (hit: no commit since the last request)
+        self.catalog_reopen_stats = {'hit': 0, 'miss': 0}
 
         # Email service
         self.spool = lfs.resolve2(self.target, 'spool')
@@ -404,8 +626,10 @@ class Server(object):
         self.smtp_host = get_value('smtp-host')
         self.smtp_login = get_value('smtp-login', default='').strip()
         self.smtp_password = get_value('smtp-password', default='').strip()
-        # Email is sent asynchronously
-        self.flush_spool()
+        # Email is sent asynchronously (by the read-write server only, the
+        # read-only workers share the same spool)
+        if not read_only:
+            self.flush_spool()
         # Logging events
         log_file = '%s/log/events' % target
         log_level = config.get_value('log-level')
@@ -440,12 +664,38 @@ class Server(object):
 
     def get_database(self):
         database = self.database
-        # Reopen so if we have one readonly request it will works
+        # The read-write server counts its commits, a read-only server
+        # looks at the stamp written by the read-write server
+        if self.read_only:
+            generation = get_commit_stamp(database)
+        else:
+            generation = database.generation
+        # Reopen the catalog only if there was a commit since the last time
+        stats = self.catalog_reopen_stats
+        if generation == self.catalog_generation:
+            stats['hit'] += 1
+            return database
+        stats['miss'] += 1
+        self.catalog_generation = generation
+        # Read-only server: drop the cached handlers and values too
+        if self.read_only:
+            database.cache.clear()
+            clear_caches()
         database.backend.catalog._db.reopen()
         # Ok
         return database
 
 
+    def get_stats(self):
+        """Return the hit/miss counters of the server caches.
+        """
+        stats = get_caches_stats()
+        stats['catalog_reopen'] = self.catalog_reopen_stats
+        stats['thumbnails'] = thumbnails.stats
+        stats['static'] = static_assets.stats
+        return stats
+
+
     def check_consistency(self, quick):
         log_info('Check database consistency')
         # Check the server is not running
@@ -462,7 +712,7 @@ class Server(object):
         return True
 
 
-    def start(self, detach=False, profile=False, loop=True):
+    def start(self, detach=False, profile=False, loop=True, listener=None):
         msg = 'Start database %s %s %s' % (detach, profile, loop)
         log_info(msg)
         self.profile = '{0}/log/profile'.format(self.target) if profile else None
@@ -488,7 +738,7 @@ class Server(object):
         # Listen & set context
         if not self.read_only:
             self.launch_cron()
-        self.listen(address, self.port)
+        self.listen(address, self.port, listener)
 
         # XXX The interpreter do not go here
         #self.server.root.launch_at_stop(context)
@@ -501,12 +751,27 @@ class Server(object):
         interval = self.config.get_value('cron-interval')
         if interval:
             cron(self.cron_manager, interval)
+        self.cron_launched = True
+        # Finish the re-indexation of the allowed viewers, if it was
+        # interrupted
+        self.launch_viewers_index()
 
 
-    def reindex_catalog(self, quiet=False, quick=False, as_test=False):
+    def launch_viewers_index(self):
+        """Start the re-indexation of the allowed viewers (after a change of
+        the access rules), unless it is running already.
+        """
+        if not self.cron_launched or self.viewers_index_running:
+            return
+        self.viewers_index_running = True
+        cron(self.viewers_index_manager, timedelta(seconds=1))
+
+
+    def reindex_catalog(self, quiet=False, quick=False, as_test=False,
+                        jobs=1):
         # FIXME: should be moved into backend
         from itools.database.backends.catalog import make_catalog
-        msg = 'reindex catalog %s %s %s' % (quiet, quick, as_test)
+        msg = 'reindex catalog %s %s %s %s' % (quiet, quick, as_test, jobs)
         log_info(msg)
         if self.is_running_in_rw_mode():
             print 'Cannot proceed, the server is running in read-write mode.'
@@ -520,32 +785,28 @@ class Server(object):
         root = self.root
         # Update
         t0, v0 = time(), vmsize()
-        doc_n = 0
         error_detected = False
         if as_test:
             log = open('%s/log/update-catalog' % self.target, 'w').write
-        with self.database.init_context() as context:
-            for obj in root.traverse_resources():
-                if not quiet or doc_n % 10000==0:
-                    print('{0} {1}'.format(doc_n, obj.abspath))
-                doc_n += 1
-                context.resource = obj
-                values = obj.get_catalog_values()
-                # Index the document
-                try:
-                    catalog.index_document(values)
-                except Exception:
-                    if as_test:
-                        error_detected = True
-                        log('*** Error detected ***\n')
-                        log('Abspath of the resource: %r\n\n' % str(obj.abspath))
-                        log(format_exc())
-                        log('\n')
-                    else:
-                        raise
-                # Free Memory
-                del obj
-                self.database.make_room()
+        if jobs > 1:
+            documents = self.iter_catalog_shards(jobs, quiet)
+        else:
+            resources = root.traverse_resources()
+            documents = self.iter_catalog_values(self.database, root,
+                                                 resources, quiet)
+        for values in documents:
+            # Index the document
+            try:
+                catalog.index_document(values)
+            except Exception:
+                if as_test:
+                    error_detected = True
+                    log('*** Error detected ***\n')
+                    log('Abspath of the resource: %r\n\n' % values['abspath'])
+                    log(format_exc())
+                    log('\n')
+                else:
+                    raise
 
         if not error_detected:
             if as_test:
@@ -578,6 +839,93 @@ class Server(object):
             return False
 
 
+    def iter_catalog_values(self, database, root, resources, quiet,
+                            shard=None):
+        """Yield the catalog values of the given resources.
+        """
+        doc_n = 0
+        with database.init_context() as context:
+            context.indexing = IndexingCache(root)
+            # Do not keep every resource in memory (see ResourcesMap)
+            context.resources_map = None
+            for obj in resources:
+                if not quiet or doc_n % 10000==0:
+                    msg = '{0} {1}'.format(doc_n, obj.abspath)
+                    if shard is not None:
+                        msg = '[{0}] {1}'.format(shard, msg)
+                    print(msg)
+                doc_n += 1
+                context.resource = obj
+                values = obj.get_catalog_values()
+                values['catalog_digest'] = get_catalog_digest(values)
+                yield values
+                # Free Memory
+                del obj
+                database.make_room()
+
+
+    def iter_catalog_shards(self, jobs, quiet):
+        """Compute the catalog values with the given number of processes,
+        every process writes the values of its share of the resources (see
+        get_shard_resources) to a file. Then yield the values of all the
+        files.
+        """
+        paths = [ '%s/catalog.new.%d' % (self.target, shard)
+                  for shard in range(jobs) ]
+        pids = []
+        for shard, path in enumerate(paths):
+            pid = fork()
+            if pid == 0:
+                status = 0
+                try:
+                    self.make_catalog_shard(shard, jobs, path, quiet)
+                except Exception:
+                    print(format_exc())
+                    status = 1
+                sys.stdout.flush()
+                _exit(status)
+            pids.append(pid)
+
+        try:
+            failed = [ x for x, y in enumerate(pids)
+                       if waitpid(y, 0)[1] != 0 ]
+            if failed:
+                raise RuntimeError('the catalog shards %s failed' % failed)
+            # Merge
+            doc_n = 0
+            for path in paths:
+                with open(path, 'rb') as file:
+                    while True:
+                        try:
+                            values = pickle.load(file)
+                        except EOFError:
+                            break
+                        if doc_n % 10000 == 0:
+                            print('[Merge] {0} {1}'.format(doc_n,
+                                                           values['abspath']))
+                        doc_n += 1
+                        yield values
+        finally:
+            for path in paths:
+                if exists(path):
+                    remove(path)
+
+
+    def make_catalog_shard(self, shard, jobs, path, quiet):
+        """Write to the given file the catalog values of the given share of
+        the resources (in a child process, with its own read-only database).
+        """
+        size_min, size_max = self.cache_size
+        database = get_database(self.target, size_min, size_max,
+                                read_only=True)
+        root = get_root(database)
+        resources = get_shard_resources(root, shard, jobs)
+        with open(path, 'wb') as file:
+            for values in self.iter_catalog_values(database, root, resources,
+                                                   quiet, shard):
+                pickle.dump(values, file, pickle.HIGHEST_PROTOCOL)
+
+
     def get_pid(self):
         return get_pid('%s/pid' % self.target)
 
@@ -612,7 +960,7 @@ class Server(object):
         self.close()
 
 
-    def listen(self, address, port):
+    def listen(self, address, port, listener=None):
         # Language negotiation
         # init_language_selector(select_language)
         # Say hello
@@ -620,7 +968,10 @@ class Server(object):
         log_info(msg)
         self.port = port
         # Say hello
-        msg = 'Listen %s:%d' % (address, port)
+        if listener is None:
+            msg = 'Listen %s:%d' % (address, port)
+        else:
+            msg = 'Listen %s' % (listener.getsockname() or address)
         print(msg)
         # Serve
         log_info(msg)
@@ -628,7 +979,7 @@ class Server(object):
             address = ''
         self.port = port
         self.wsgi_server = WSGIServer(
-            (address or '', port), application,
+            listener or (address or '', port), application,
             handler_class=ServerHandler,
             log=self.access_log)
         # gevent_signal(SIGTERM, self.stop)
@@ -639,6 +990,20 @@ class Server(object):
             self.wsgi_server.serve_forever()
 
 
+    def start_worker(self, listener, writer_address):
+        """Serve the GET and HEAD requests in a pre-forked read-only worker,
+        the other requests are forwarded to the writer.
+        """
+        log_info('Start read-only worker %s' % getpid())
+        self.writer_address = writer_address
+        self.profile = None
+        self.wsgi_server = WSGIServer(
+            listener, worker_application,
+            handler_class=ServerHandler,
+            log=self.access_log)
+        self.wsgi_server.serve_forever()
+
+
     #def save_running_informations(self):
     #    # Save server running informations
     #    kw = {'pid': getpid(),
@@ -788,6 +1153,11 @@ class Server(object):
             mount_path = '/ui/cached/%s/%s' % (ts, name)
             view = CachedStaticView(local_path=skin_key, mount_path=mount_path)
             self.dispatcher.add('/ui/cached/%s/%s/{name:any}' % (ts, name), view)
+        # Bundles of style sheets and scripts
+        self.dispatcher.add('/ui/bundles/{name:any}', BundleView)
+        # Keep the static files in memory, and load the templates
+        static_assets.load(self)
+        template_registry.load(self)
 
 
     def register_urlpatterns_from_package(self, package):
@@ -878,6 +1248,30 @@ class Server(object):
         return self.config.get_value('cron-interval')
 
 
+    def viewers_index_manager(self):
+        """Re-index the allowed viewers by batches, each batch is committed
+        on its own so the requests are not blocked for long.
+        """
+        with self.database.init_context() as context:
+            context.is_cron = True
+            context.set_mtime = False
+            context.git_message = u'[CRON] Re-index the allowed viewers'
+            access = context.root.get_resource('/config/access', soft=True)
+            if access is None:
+                self.viewers_index_running = False
+                return False
+            try:
+                more = access.update_viewers_index()
+            except Exception:
+                log_error('Allowed viewers error\n' + format_exc())
+                self.database.abort_changes()
+                return 60
+        # Next batch right away, or stop until the rules change again
+        if not more:
+            self.viewers_index_running = False
+        return more
+
+
 
     def do_request(self, method='GET', path='/', headers=None, body='',
             context=None, as_json=False, as_multipart=False, files=None, user=None, cookies=None):
@@ -997,9 +1391,24 @@ class ServerConfig(ConfigFile):
         # Tuning
         'database-size': String(default='19500:20500'),
         'database-readonly': Boolean(default=False),
+        'database-lock': String(default='exclusive'),
+        'group-commit': Integer(default=0),
+        'group-commit-size': Integer(default=20),
+        'page-cache': Integer(default=0),
+        'page-cache-stale': Integer(default=60),
+        'page-cache-size': Integer(default=1000),
+        'gzip-level': Integer(default=6),
+        'gzip-min-size': Integer(default=1024),
+        'gzip-types': Tokens(default=('text/html', 'application/json',
+                                      'text/css', 'text/plain', 'text/xml',
+                                      'application/javascript',
+                                      'application/xml')),
+        'onchange-index': Boolean(default=False),
         'index-text': Boolean(default=True),
         'max-width': Integer(default=None),
         'max-height': Integer(default=None),
+        'thumbnail-cache-size': Integer(default=500),
+        'thumbnail-sizes': Tokens(default=()),
     }
 
 
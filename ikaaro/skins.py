@@ -31,9 +31,11 @@ from itools.stl import stl
 from itools.web import get_context, ERROR, INFO
 
 # Import from ikaaro
+from assets import static_assets
 from folder import Folder
 from views import get_view_scripts
 from skins_views import LanguagesTemplate, LocationTemplate, TabsTemplate
+from utils import get_fragment
 
 
 class Skin(object):
@@ -103,13 +105,23 @@ class Skin(object):
         return None
 
 
-    def get_styles(self, context):
-        # Generic
-        styles = ['/ui/aruni/dist/style.css']
+    def get_skin_styles(self):
+        # Computed once (do not look for the files on every page), but in
+        # the development environment
+        styles = getattr(self, '_styles', None)
+        if styles is None or static_assets.check_mtime:
+            # Generic
+            styles = ['/ui/aruni/dist/style.css']
+            # Skin
+            if isfile('%s/style.css' % self.key):
+                styles.append('%s/style.css' % self.base_path)
+            if not static_assets.check_mtime:
+                self._styles = styles
+        return styles
 
-        # Skin
-        if isfile('%s/style.css' % self.key):
-            styles.append('%s/style.css' % self.base_path)
+
+    def get_styles(self, context):
+        styles = list(self.get_skin_styles())
 
         # View
         get_styles = getattr(context.view, 'get_styles', None)
@@ -125,17 +137,25 @@ class Skin(object):
                 '/config/theme/;get_file?name=style&mimetype=text/css')
 
         # Ok
-        return styles
+        return static_assets.bundle(styles, context)
+
+
+    def get_skin_scripts(self):
+        scripts = getattr(self, '_scripts', None)
+        if scripts is None or static_assets.check_mtime:
+            scripts = [
+                '/ui/ikaaro/jquery.js',
+                '/ui/ikaaro/javascript.js']
+            # This skin's JavaScript
+            if isfile('%s/javascript.js' % self.key):
+                scripts.append('%s/javascript.js' % self.base_path)
+            if not static_assets.check_mtime:
+                self._scripts = scripts
+        return scripts
 
 
     def get_scripts(self, context):
-        scripts = [
-            '/ui/ikaaro/jquery.js',
-            '/ui/ikaaro/javascript.js']
-
-        # This skin's JavaScript
-        if isfile('%s/javascript.js' % self.key):
-            scripts.append('%s/javascript.js' % self.base_path)
+        scripts = list(self.get_skin_scripts())
 
         # View
         for script in get_view_scripts(context.view, context):
@@ -143,7 +163,7 @@ class Skin(object):
                 scripts.append(script)
 
         # Ok
-        return scripts
+        return static_assets.bundle(scripts, context)
 
 
     def get_meta_tags(self, context):
@@ -292,12 +312,26 @@ class Skin(object):
 
     def get_footer(self, context):
         footer = context.root.get_resource('config/footer')
-        return footer.get_html_data()
+        return get_fragment(context, 'footer', ('language',),
+                            footer.get_html_data, ['/config/footer'])
 
 
     def get_menu_namespace(self, context):
+        def get_depends(items):
+            # The menu, and the linked resources (their access rules)
+            depends = ['/config', '/users']
+            items = list(items)
+            while items:
+                item = items.pop()
+                if item['real_path']:
+                    depends.append(str(item['real_path']))
+                items.extend(item['items'] or [])
+            return depends
+
         menu = context.root.get_resource('config/menu')
-        return menu.get_menu_namespace(context)
+        return get_fragment(context, 'menu', ('user', 'language', 'path'),
+                            lambda: menu.get_menu_namespace(context),
+                            get_depends)
 
 
     #######################################################################
@@ -72,9 +72,21 @@ class LanguagesTemplate(CMSTemplate):
 class LocationTemplate(CMSTemplate):
 
     template = '/ui/aruni/location.xml'
+    fragment = 'breadcrumb'
+    fragment_inputs = ('user', 'language', 'path', 'view', 'query')
 
     keep_view_and_query = False
 
+
+    def get_fragment_depends(self):
+        # The resources of the breadcrumb (their title)
+        depends = ['/', '/config', '/users']
+        path = ''
+        for name in self.context.uri.path:
+            path = '%s/%s' % (path, name)
+            depends.append(path)
+        return depends
+
     def get_url(self, path):
         if not self.keep_view_and_query:
             return path
@@ -132,6 +144,14 @@ class LocationTemplate(CMSTemplate):
 class TabsTemplate(CMSTemplate):
 
     template = '/ui/aruni/tabs.xml'
+    fragment = 'tabs'
+    fragment_inputs = ('user', 'language', 'path', 'view', 'query')
+
+
+    def get_fragment_depends(self):
+        depends = ['/config', '/users']
+        depends.append(str(self.context.resource.abspath))
+        return depends
 
 
     @proto_lazy_property
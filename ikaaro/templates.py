@@ -0,0 +1,139 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Registry of the files of the skins, made when the server starts.
+
+The templates are loaded (parsed) at once, and the language variants of
+every file ("template.xml.en", "template.xml.fr") are indexed, so
+context.get_template does not look at the file system. In the development
+environment the registry is not used, the changes are seen at once.
+"""
+
+# Import from the Standard Library
+from os import walk
+from os.path import join
+from posixpath import normpath
+
+# Import from itools
+from itools.database.ro import ro_database
+from itools.i18n import has_language
+from itools.log import log_warning
+
+# Import from ikaaro
+from cache import is_prefix
+
+
+template_extensions = ('.xml', '.xhtml', '.html')
+
+
+def is_template(name):
+    for extension in template_extensions:
+        if name.endswith(extension) or (extension + '.') in name:
+            return True
+    return False
+
+
+
+class TemplateRegistry(object):
+
+    def __init__(self):
+        self.roots = ()
+        # The files, the language variants {path: [language, ...]} and the
+        # loaded templates {path: handler}
+        self.files = set()
+        self.variants = {}
+        self.templates = {}
+
+
+    def load(self, server):
+        from skins import skin_registry
+
+        self.roots = ()
+        self.files = set()
+        self.variants = {}
+        self.templates = {}
+        if server.is_development_environment():
+            return
+
+        roots = set()
+        for skin in skin_registry.itervalues():
+            roots.add(normpath(skin.key))
+            roots.add(normpath(skin.get_environment_key(server)))
+        for root in roots:
+            self.load_folder(root)
+        self.roots = tuple(roots)
+
+
+    def load_folder(self, local_path):
+        for dirpath, dirnames, filenames in walk(local_path):
+            for filename in filenames:
+                path = join(dirpath, filename)
+                self.files.add(path)
+                # Language variant
+                if '.' in filename:
+                    name, language = path.rsplit('.', 1)
+                    if has_language(language):
+                        self.variants.setdefault(name, []).append(language)
+                # Load the templates
+                if is_template(filename):
+                    handler = ro_database.get_handler(path, soft=True)
+                    if handler is None:
+                        continue
+                    try:
+                        if handler.timestamp is None:
+                            handler.load_state()
+                    except Exception:
+                        log_warning('Cannot load template %s' % path,
+                                    domain='ikaaro')
+                        continue
+                    self.templates[path] = handler
+
+
+    def has_path(self, local_path):
+        """Tells whether the given path is handled by the registry.
+        """
+        return is_prefix(self.roots, normpath(local_path))
+
+
+    def get_template(self, local_path, accept_language):
+        """Return the handler of the given path, or of the best language
+        variant. Return None if there is not such a file.
+        """
+        local_path = normpath(local_path)
+        # Exact match
+        if local_path in self.files:
+            handler = self.templates.get(local_path)
+            if handler is None:
+                handler = ro_database.get_handler(local_path, soft=True)
+            return handler
+
+        # Language negotiation
+        languages = self.variants.get(local_path)
+        if not languages:
+            return None
+        language = accept_language.select_language(languages)
+        # By default use whatever variant
+        # (XXX we need a way to define the default)
+        if language is None:
+            language = languages[0]
+        local_path = '%s.%s' % (local_path, language)
+        handler = self.templates.get(local_path)
+        if handler is None:
+            handler = ro_database.get_handler(local_path, soft=True)
+        return handler
+
+
+
+template_registry = TemplateRegistry()
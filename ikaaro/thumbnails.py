@@ -0,0 +1,163 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""On-disk cache of the image thumbnails.
+
+The thumbnails are stored in the "thumbnails" folder of the instance, one
+folder by image handler (so they are removed at once when the image
+changes), one file by (modification time, width, height, format, fit). The
+least recently used thumbnails are removed when the cache is bigger than
+its maximum size.
+"""
+
+# Import from the Standard Library
+from hashlib import sha1
+from os import makedirs, remove, rename, stat, utime, walk
+from os.path import exists, join
+from shutil import rmtree
+from uuid import uuid4
+
+# Import from itools
+from itools.log import log_warning
+
+
+class ThumbnailCache(object):
+
+    def __init__(self):
+        self.path = None
+        self.size_max = 0
+        self.size = None
+        self.stats = {'hit': 0, 'miss': 0}
+
+
+    def configure(self, path, size_max):
+        """The cache is disabled if size_max (in bytes) is zero.
+        """
+        self.path = path if size_max else None
+        self.size_max = size_max
+        self.size = None
+
+
+    def get_folder(self, key):
+        name = sha1(key).hexdigest()
+        return join(self.path, name[:2], name)
+
+
+    def get_thumbnail(self, handler, width, height, format=None, fit=False):
+        """Same as handler.get_thumbnail, but using the cache.
+        """
+        if self.path is None:
+            return handler.get_thumbnail(width, height, format, fit)
+
+        folder = self.get_folder(handler.key)
+        name = '%s:%s:%s:%s:%s' % (handler.get_mtime(), width, height, format,
+                                   fit)
+        path = join(folder, sha1(name).hexdigest())
+
+        # Hit
+        try:
+            with open(path, 'rb') as f:
+                format = f.readline().strip()
+                data = f.read()
+        except IOError:
+            pass
+        else:
+            self.stats['hit'] += 1
+            try:
+                utime(path, None)
+            except OSError:
+                pass
+            return data, format
+
+        # Miss
+        self.stats['miss'] += 1
+        data, format = handler.get_thumbnail(width, height, format, fit)
+        if data is not None:
+            self.set(folder, path, data, format)
+        return data, format
+
+
+    def set(self, folder, path, data, format):
+        try:
+            if not exists(folder):
+                makedirs(folder)
+            # Write then rename, other processes may read the same file
+            tmp_path = '%s.%s' % (path, uuid4().hex)
+            with open(tmp_path, 'wb') as f:
+                f.write('%s\n' % format)
+                f.write(data)
+            rename(tmp_path, path)
+        except (IOError, OSError):
+            log_warning('Cannot write thumbnail %s' % path, domain='ikaaro')
+            return
+
+        # Free space if needed
+        if self.size is None:
+            self.size = self.get_size()
+        else:
+            self.size += len(data)
+        if self.size > self.size_max:
+            self.evict()
+
+
+    def get_files(self):
+        files = []
+        for dirpath, dirnames, filenames in walk(self.path):
+            for filename in filenames:
+                path = join(dirpath, filename)
+                try:
+                    st = stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+        return files
+
+
+    def get_size(self):
+        return sum([ x[1] for x in self.get_files() ])
+
+
+    def evict(self):
+        """Remove the least recently used thumbnails, until the cache size
+        is down to 90% of its maximum size.
+        """
+        files = self.get_files()
+        files.sort()
+        size = sum([ x[1] for x in files ])
+        size_min = self.size_max * 9 / 10
+        for mtime, file_size, path in files:
+            if size <= size_min:
+                break
+            try:
+                remove(path)
+            except OSError:
+                continue
+            size -= file_size
+        self.size = size
+
+
+    def invalidate(self, key):
+        """Remove the thumbnails of the given handler.
+        """
+        if self.path is None:
+            return
+        folder = self.get_folder(key)
+        if exists(folder):
+            rmtree(folder, ignore_errors=True)
+            self.size = None
+
+
+
+thumbnails = ThumbnailCache()
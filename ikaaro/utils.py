@@ -19,6 +19,7 @@
 # Import from the Standard Library
 from hashlib import sha1, sha256
 from random import sample
+from types import GeneratorType
 
 # Import from other modules
 try:
@@ -27,6 +28,7 @@ except ImportError:
     tidy = None
 
 # Import from itools
+from itools.core import local_tz
 from itools.database import AllQuery, AndQuery, PhraseQuery, OrQuery
 from itools.database import RangeQuery
 from itools.datatypes import Unicode
@@ -34,9 +36,12 @@ from itools.handlers import checkid
 from itools.html import HTMLParser, stream_to_str_as_xhtml
 from itools.stl import STLTemplate, stl_namespaces
 from itools.uri import get_reference, Reference
-from itools.web import get_context
+from itools.web import get_context, NotModified
 from itools.xml import XMLParser
 
+# Import from ikaaro
+from cache import PageCache
+
 
 ###########################################################################
 # CMS Template
@@ -51,6 +56,27 @@ class CMSTemplate(STLTemplate):
 
     template = None
 
+    # Fragment cache: set the name of the fragment and the inputs it
+    # depends on (see get_fragment_key) to render it once
+    fragment = None
+    fragment_inputs = ()
+
+
+    def get_fragment_depends(self):
+        """Return the paths of the resources the rendering depends on.
+        """
+        return ['/config', '/users']
+
+
+    def render(self, mode='events'):
+        proxy = super(CMSTemplate, self)
+        if self.fragment is None:
+            return proxy.render(mode)
+        name = (self.fragment, self.template, mode)
+        return get_fragment(get_context(), name, self.fragment_inputs,
+                            lambda: proxy.render(mode),
+                            self.get_fragment_depends())
+
     def get_template(self):
         # Get the template
         template = self.template
@@ -74,6 +100,69 @@ class CMSTemplate(STLTemplate):
 
 
 
+###########################################################################
+# Fragment cache
+###########################################################################
+fragment_cache = PageCache('fragments', size=5000, ttl=3600)
+
+
+def get_fragment_key(context, name, inputs):
+    """Return the key of a fragment, made of its name and the value of the
+    given inputs:
+
+    - user: the user (None for anonymous)
+    - groups: the groups of the user
+    - language: the language of the page
+    - path: the path of the request
+    - view: the view name
+    - query: the query of the request
+    - skin: the skin
+    """
+    key = [name]
+    user = context.user
+    for input in inputs:
+        if input == 'user':
+            value = str(user.abspath) if user else None
+        elif input == 'groups':
+            value = tuple(sorted(user.get_value('groups'))) if user else None
+        elif input == 'language':
+            languages = context.root.get_value('website_languages')
+            value = context.accept_language.select_language(languages)
+        elif input == 'path':
+            value = str(context.uri.path)
+        elif input == 'view':
+            value = context.view_name
+        elif input == 'query':
+            value = context.environ.get('QUERY_STRING')
+        elif input == 'skin':
+            value = context.root.get_skin(context).base_path
+        else:
+            raise ValueError, 'unexpected fragment input "%s"' % input
+        key.append(value)
+    return tuple(key)
+
+
+def get_fragment(context, name, inputs, make, depends):
+    """Return the fragment from the cache, or made by calling 'make'. The
+    fragment is removed from the cache when a resource in 'depends' (a list
+    of paths, or a function that returns it from the fragment) changes.
+    """
+    key = get_fragment_key(context, name, inputs)
+    value, revalidate = fragment_cache.lookup(key)
+    if value is not None:
+        return value
+
+    value = make()
+    # The events are a generator
+    if type(value) is GeneratorType:
+        value = list(value)
+    if callable(depends):
+        depends = depends(value)
+    fragment_cache.set(key, value, depends)
+    return value
+
+
+
 ###########################################################################
 # Navigation helper functions
 ###########################################################################
@@ -342,6 +431,79 @@ def get_resource_by_uuid_query(uuid, bases_class_id=None, class_id=None):
     return query
 
 
+###########################################################################
+# Conditional requests (HTTP cache validators)
+###########################################################################
+def get_etag(*args):
+    """Return a strong entity tag, built from the given values (typically
+    the handler key and its modification time).
+    """
+    data = ':'.join([ str(x) for x in args ])
+    return '"%s"' % sha1(data).hexdigest()
+
+
+def check_conditional_get(context, etag, mtime=None):
+    """Set the ETag and Last-Modified headers, and raise NotModified if the
+    copy of the client is still valid. If-None-Match has precedence over
+    If-Modified-Since (RFC 7232).
+    """
+    context._set_header('ETag', etag)
+    if mtime is not None:
+        mtime = mtime.replace(microsecond=0)
+        # If naive, assume local time (like itools)
+        if mtime.tzinfo is None:
+            mtime = local_tz.localize(mtime)
+        context.set_header('Last-Modified', mtime)
+
+    if_none_match = context.environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        tags = [ x.strip() for x in if_none_match.split(',') ]
+        tags = [ x[2:] if x[:2] == 'W/' else x for x in tags ]
+        if '*' in tags or etag in tags:
+            raise NotModified
+        return
+
+    if mtime is not None:
+        since = context.get_header('If-Modified-Since')
+        if since and since >= mtime:
+            raise NotModified
+
+
+def get_byte_ranges(header, size):
+    """Parse the value of the Range header, return the list of the ranges
+    (start, end) that can be satisfied, the end is included. Returns None
+    if the header is missing or not valid (then the whole body is sent).
+    """
+    if not header:
+        return None
+    unit, sep, specs = header.partition('=')
+    if unit.strip() != 'bytes' or not sep:
+        return None
+
+    ranges = []
+    for spec in specs.split(','):
+        start, sep, end = spec.strip().partition('-')
+        if not sep:
+            return None
+        try:
+            if start == '':
+                # Suffix: the last bytes
+                length = int(end)
+                if length > 0 and size > 0:
+                    ranges.append((max(size - length, 0), size - 1))
+                continue
+            start = int(start)
+            end = int(end) if end else size - 1
+        except ValueError:
+            return None
+        if end < start:
+            return None
+        if start < size:
+            ranges.append((start, min(end, size - 1)))
+
+    return ranges
+
+
 ###########################################################################
 # Fancy box (javascript)
 ###########################################################################
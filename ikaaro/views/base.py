@@ -37,7 +37,9 @@ from itools.xml import XMLParser
 # Import from ikaaro
 from ikaaro.autoform import AutoForm
 from ikaaro.buttons import Button
-from ikaaro.utils import CMSTemplate
+from ikaaro.assets import is_bundleable, static_assets
+from ikaaro.utils import CMSTemplate, check_conditional_get
+from ikaaro.web.wsgi import compression
 
 
 """This module contains some generic views used by different resources.
@@ -619,13 +621,16 @@ class ContextMenu(CMSTemplate):
 
 
 class IkaaroStaticView(StaticView):
-
+    """Serve the static files of the skins, from memory when possible (see
+    ikaaro.assets).
+    """
 
     def GET(self, resource, context):
+        path = str(context.path)
+        ts = context.server.timestamp
+        path = path.replace('/cached/%s' % ts, '')
         try:
-            return self.get_from_template(resource, context)
-        except NotModified:
-            raise
+            asset = static_assets.lookup(path, context)
         except Exception:
             # Fallback if the handler cannot be loaded
             msg = 'WARNING: The file {0} contains errors'.format(context.path)
@@ -634,31 +639,25 @@ class IkaaroStaticView(StaticView):
             print(traceback.format_exc())
             print('=='*10)
             return self.get_fallback(resource, context)
-
-
-    def get_from_template(self, resource, context):
-        # FIXME Check we set the encoding for text files
-        path = str(context.path)
-        ts = context.server.timestamp
-        path = path.replace('/cached/%s' % ts, '')
-        template = context.get_template(path)
         # 404 Not Found
-        if not template:
+        if asset is None:
             return context.set_default_response(404)
+        return self.get_asset(asset, context)
+
+
+    def get_asset(self, asset, context):
         # 304 Not Modified
-        mtime = template.get_mtime()
-        mtime = fixed_offset(0).localize(mtime)
-        since = context.get_header('If-Modified-Since')
-        if since and since >= mtime:
-            raise NotModified
-        mimetype = template.get_mimetype()
-        # Get data
-        data = template.to_str()
+        check_conditional_get(context, asset.etag, asset.mtime)
         # Response
         context.status = 200
-        context.set_content_type(mimetype)
-        context.set_header('Last-Modified', mtime)
-        return data
+        context.set_content_type(asset.mimetype)
+        if asset.gzip is None:
+            return asset.data
+        context.set_header('Vary', 'Accept-Encoding')
+        if not compression.accepts_gzip(context.environ):
+            return asset.data
+        context.set_header('Content-Encoding', 'gzip')
+        return asset.gzip
 
 
     def get_fallback(self, resource, context):
@@ -698,3 +697,29 @@ class CachedStaticView(IkaaroStaticView):
         if context.status == 200:
             context.set_header('Cache-Control', 'max-age=315360000')
         return data
+
+
+
+class BundleView(CachedStaticView):
+    """Serve the bundles of style sheets and scripts (see ikaaro.assets),
+    made again from the files listed in the query if not in memory.
+    """
+
+    def GET(self, query, context):
+        path = str(context.path)
+        asset = static_assets.get(path)
+        if asset is None:
+            files = context.uri.query.get('files') or ''
+            files = [ x for x in files.split(',') if is_bundleable(x) ]
+            if not files:
+                return context.set_default_response(404)
+            asset = static_assets.get_bundle(files, context)
+            if asset is None:
+                return context.set_default_response(404)
+            # The files changed, or they are not those of the bundle
+            if static_assets.get_bundle_path(files, asset) != path:
+                return context.set_default_response(404)
+            static_assets.assets[path] = asset
+        data = self.get_asset(asset, context)
+        context.set_header('Cache-Control', 'max-age=315360000')
+        return data
@@ -37,6 +37,7 @@ from ikaaro.buttons import Remove_BrowseButton, RenameButton, CopyButton, CutBut
 from ikaaro.buttons import ZipButton
 from ikaaro.datatypes import CopyCookie
 from ikaaro.exceptions import ConsistencyError
+from ikaaro.thumbnails import thumbnails
 from ikaaro.utils import generate_name, get_base_path_query
 from ikaaro.widgets import SelectWidget, TextWidget
 from ikaaro import messages
@@ -472,11 +473,15 @@ class Folder_BrowseContent(BrowseForm):
             elif start:
                 items = items[start:]
             database = resource.database
-            return [ database.get_resource(x.abspath) for x in items ]
+            items = [ database.get_resource(x.abspath) for x in items ]
+        else:
+            # Case 2: Faster Xapian sort algorithm
+            items = results.get_resources(sort_by, reverse, start, size)
+            items = list(items)
 
-        # Case 2: Faster Xapian sort algorithm
-        items = results.get_resources(sort_by, reverse, start, size)
-        return list(items)
+        # Check the actions permission on the whole page at once
+        context.root.has_permissions(context.user, 'edit', items)
+        return items
 
 
     def get_item_value(self, resource, context, item, column):
@@ -863,12 +868,8 @@ class Folder_Thumbnail(BaseView):
             # Default icon for empty or inaccessible folders
             width = context.get_form_value('width', type=Integer(), default=48)
             height = context.get_form_value('height', type=Integer(), default=48)
-            data, format = default_icon.get_thumbnail(width, height)
-
-        # XXX Don't cache nothing here
-        # The image thumbnail was cached in the image handler
-        # The folder thumbnail was cached in the folder handler
-        # Accessible images depend on too many parameters
+            data, format = thumbnails.get_thumbnail(default_icon, width,
+                                                    height)
 
         context.content_type = 'image/%s' % format
         return data
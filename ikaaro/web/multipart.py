@@ -0,0 +1,167 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Incremental parser of multipart/form-data bodies.
+
+The body is read by chunks from the input, the uploaded files are kept in
+memory up to 'spool_size' bytes, then written to a temporary file. The
+value of a file field is the tuple (filename, mimetype, file).
+"""
+
+# Import from the Standard Library
+from tempfile import SpooledTemporaryFile
+
+# Import from itools
+from itools.web.headers import get_type
+
+
+chunk_size = 65536
+spool_size = 1024 * 1024
+
+
+class MultipartReader(object):
+
+    def __init__(self, input, length, progress=None):
+        self.input = input
+        self.length = length
+        self.remaining = length
+        self.progress = progress
+        self.buffer = ''
+
+
+    def fill(self):
+        """Read the next chunk of the input, returns False at the end.
+        """
+        if self.remaining <= 0:
+            return False
+        data = self.input.read(min(chunk_size, self.remaining))
+        if not data:
+            self.remaining = 0
+            return False
+        self.remaining -= len(data)
+        self.buffer += data
+        if self.progress:
+            self.progress(self.length - self.remaining, self.length)
+        return True
+
+
+    def read_until(self, marker, write):
+        """Consume the input up to the given marker (the marker included),
+        the data before the marker is given to the 'write' function.
+        """
+        keep = len(marker) - 1
+        while True:
+            index = self.buffer.find(marker)
+            if index != -1:
+                write(self.buffer[:index])
+                self.buffer = self.buffer[index + len(marker):]
+                return
+            # Keep the end, the marker may be cut between two chunks
+            if len(self.buffer) > keep:
+                write(self.buffer[:-keep])
+                self.buffer = self.buffer[-keep:]
+            if not self.fill():
+                raise ValueError('unexpected end of the multipart body')
+
+
+    def startswith(self, prefix):
+        while len(self.buffer) < len(prefix) and self.fill():
+            pass
+        return self.buffer.startswith(prefix)
+
+
+
+def ignore(data):
+    pass
+
+
+def parse_headers(data):
+    headers = {}
+    for line in data.split('\r\n'):
+        if not line:
+            continue
+        if ':' not in line:
+            raise ValueError('malformed header "%s"' % line)
+        name, value = line.split(':', 1)
+        name = name.strip().lower()
+        headers[name] = get_type(name).decode(value.strip())
+    return headers
+
+
+
+def read_multipart(input, length, boundary, progress=None):
+    """Read a multipart/form-data body of the given length from the input
+    (a file object), and return the form as a dict. If given the 'progress'
+    function is called with the size read so far and the total size.
+    """
+    if not boundary:
+        raise ValueError('the multipart boundary is missing')
+    delimiter = '\r\n--%s' % boundary
+
+    reader = MultipartReader(input, length, progress)
+    # The first delimiter is not preceded by a new line
+    reader.buffer = '\r\n'
+    reader.read_until(delimiter, ignore)
+
+    form = {}
+    while not reader.startswith('--'):
+        # Headers
+        data = []
+        reader.read_until('\r\n\r\n', data.append)
+        headers = parse_headers(''.join(data))
+        if 'content-disposition' not in headers:
+            raise ValueError('the Content-Disposition header is missing')
+        value, parameters = headers['content-disposition']
+        name = parameters.get('name')
+        if name is None:
+            raise ValueError('the name of the field is missing')
+
+        # Case 1: file
+        if 'filename' in parameters:
+            filename = parameters['filename']
+            if not filename:
+                reader.read_until(delimiter, ignore)
+                form[name] = None
+                continue
+            # Strip the path (for IE).
+            filename = filename.split('\\')[-1]
+            # Default content-type, see
+            # http://tools.ietf.org/html/rfc2045#section-5.2
+            if 'content-type' in headers:
+                mimetype = headers['content-type'][0]
+            else:
+                mimetype = 'text/plain'
+            file = SpooledTemporaryFile(max_size=spool_size)
+            reader.read_until(delimiter, file.write)
+            file.seek(0)
+            form[name] = filename, mimetype, file
+            continue
+
+        # Case 2: other fields
+        data = []
+        reader.read_until(delimiter, data.append)
+        value = ''.join(data)
+        if name not in form:
+            form[name] = value
+        elif isinstance(form[name], list):
+            form[name].append(value)
+        else:
+            form[name] = [form[name], value]
+
+    # Consume the epilogue
+    while reader.fill():
+        reader.buffer = ''
+
+    return form
@@ -15,39 +15,452 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from standard library
+from httplib import HTTPConnection
+from os import fstat
 from time import time
+from urlparse import parse_qs
+import zlib
+
+# Import from gevent
+from gevent import spawn
+from gevent.socket import socket, AF_UNIX, SOCK_STREAM
 
 # Import from itools
-from itools.log import log_error
+from itools.log import log_error, log_warning
 from itools.web.router import RequestMethod
+from itools.web.headers import get_type
 from itools.web.utils import reason_phrases
 
+# Import from ikaaro
+from ikaaro.cache import PageCache
+from multipart import read_multipart
+
+
+# Requests with these methods do not change the database, so they can be
+# served at the same time (if the server is configured to do so)
+safe_methods = frozenset(['GET', 'HEAD'])
+
+
+###########################################################################
+# Cache of the pages served to anonymous users
+###########################################################################
+page_cache = PageCache('pages')
+
+# Every page depends on the root and on the configuration (skin, menu...)
+page_depends = ('/', '/config')
+
+
+def get_page_cache_key(context):
+    """Return the key of the page in the cache, or None if the request must
+    not be served from the cache (only anonymous GET requests are). The skin
+    is defined by the host and the query.
+    """
+    if not page_cache.ttl or context.method != 'GET' or context.user:
+        return None
+    languages = context.root.get_value('website_languages')
+    language = context.accept_language.select_language(languages)
+    return (context.uri.authority, str(context.path), context.view_name,
+            context.environ.get('QUERY_STRING'), language)
+
+
+def set_page_cache(key, context, response):
+    # Only the successful responses of the views that declare themselves
+    # cacheable
+    view = context.view
+    if not getattr(view, 'cacheable', False) or context.status != 200:
+        return
+    status, headers, entity = response
+    if type(entity) is not str:
+        return
+    for name, value in headers:
+        if name.lower() == 'set-cookie':
+            return
+    depends = list(page_depends)
+    depends.append(str(context.resource.abspath))
+    depends.extend(getattr(view, 'cache_depends', ()))
+    page_cache.set(key, response, depends)
+
+
+def revalidate_page(environ):
+    """Compute again the page (served stale meanwhile) and store it.
+    """
+    environ = dict(environ)
+    environ['ikaaro.page_cache'] = 'revalidate'
+    get_response(environ)
+
+
+
+###########################################################################
+# Uploads
+###########################################################################
+def read_upload(environ, upload_stats):
+    """Read the multipart body of the request, before the database is
+    locked. The progress is kept in 'upload_stats' (see UploadStatsView),
+    with the "upload_id" from the query as the key. Raises ValueError if the
+    body is not valid.
+    """
+    content_type = environ.get('CONTENT_TYPE') or ''
+    if not content_type.startswith('multipart/'):
+        return
+    length = int(environ.get('CONTENT_LENGTH') or 0)
+    if not length:
+        return
+    content_type, parameters = get_type('content-type').decode(content_type)
+
+    progress = None
+    query = parse_qs(environ.get('QUERY_STRING') or '')
+    upload_id = query.get('upload_id', [''])[0]
+    if upload_id.isdigit():
+        upload_id = int(upload_id)
+        def progress(size, total):
+            upload_stats[upload_id] = (size, total)
+
+    try:
+        form = read_multipart(environ['wsgi.input'], length,
+                              parameters.get('boundary'), progress)
+    except ValueError, error:
+        log_warning('Invalid multipart body (%s)' % error, domain='ikaaro')
+        raise
+    finally:
+        if progress:
+            upload_stats.pop(upload_id, None)
+    environ['ikaaro.multipart'] = form
+
+
 
 def application(environ, start_response):
+    status, headers, entity = get_response(environ)
+    headers, entity = compression.compress(environ, status, headers, entity)
+    # The database is released before sending the body, so slow clients do
+    # not hold the lock
+    start_response(status, list(headers))
+    return get_body(environ, entity)
+
+
+
+def get_response(environ):
+    """Handle the request and return the tuple (status, headers, entity).
+    """
     from ikaaro.server import get_server
     t0 = time()
     server = get_server()
-    with server.database.init_context(commit_at_exit=False) as context:
+    read_only = environ.get('REQUEST_METHOD') in safe_methods
+    if not read_only:
         try:
+            read_upload(environ, server.upload_stats)
+        except ValueError:
+            # 400 Bad Request
+            status = '400 {0}'.format(reason_phrases[400])
+            return status, [('Content-Type', 'text/plain')], status
+    database = server.database
+    with database.init_context(commit_at_exit=False,
+                               read_only=read_only) as context:
+        key = response = None
+        try:
+            # The changes may be saved along with those of other requests
+            if not read_only and getattr(database, 'group_window', 0):
+                context.group_commit = True
             # Init context from wsgi envrion
             context.init_from_environ(environ)
-            # Handle the request
-            RequestMethod.handle_request(context)
-            t1 = time()
-            # Compute request time
-            context.request_time = t1-t0
-            # Callback at end of request
-            context.on_request_end()
+            # The page cache
+            key = get_page_cache_key(context)
+            if key and 'ikaaro.page_cache' not in environ:
+                response, revalidate = page_cache.lookup(key)
+                if revalidate:
+                    spawn(revalidate_page, environ)
+            if response is None:
+                # Handle the request
+                RequestMethod.handle_request(context)
+                t1 = time()
+                # Compute request time
+                context.request_time = t1-t0
+                # Callback at end of request
+                context.on_request_end()
         except StandardError:
             log_error('Internal error', domain='itools.web')
             context.set_default_response(500)
+            key = None
         finally:
-            headers =  context.header_response
-            if context.content_type:
-                headers.append(('Content-Type', context.content_type))
-            if context.entity:
-                headers.append(('Content-Length', str(len(context.entity))))
-            status = context.status or 500
-            status = '{0} {1}'.format(status, reason_phrases[status])
-            start_response(str(status), headers)
-            yield context.entity
+            if response is None:
+                headers =  context.header_response
+                if context.content_type:
+                    headers.append(('Content-Type', context.content_type))
+                length = get_content_length(context.entity)
+                if length and 'Content-Length' not in dict(headers):
+                    headers.append(('Content-Length', str(length)))
+                status = context.status or 500
+                status = '{0} {1}'.format(status, reason_phrases[status])
+                response = str(status), headers, context.entity
+                if key:
+                    set_page_cache(key, context, response)
+        # A write request that did not change anything may have seen the
+        # changes of the group, it fails if they are lost
+        group = getattr(database, 'group', None)
+        if context.group_commit is True and group:
+            context.group_commit = group[-1][2]
+    # Group commit: the response is sent once the changes are saved
+    result = context.group_commit
+    if result is not None and result is not True:
+        try:
+            result.get()
+        except Exception:
+            log_error('Group commit failed', domain='itools.web')
+            status = '500 {0}'.format(reason_phrases[500])
+            response = status, [('Content-Type', 'text/plain')], 'Error'
+    return response
+
+
+###########################################################################
+# Response body: a string, a file (streamed) or any iterable
+###########################################################################
+chunk_size = 65536
+
+
+def get_content_length(entity):
+    if type(entity) is str:
+        return len(entity)
+    if hasattr(entity, 'fileno'):
+        return fstat(entity.fileno()).st_size - entity.tell()
+    # Unknown (the view may set the Content-Length header)
+    return None
+
+
+def iter_file(file):
+    try:
+        while True:
+            data = file.read(chunk_size)
+            if not data:
+                break
+            yield data
+    finally:
+        file.close()
+
+
+def get_body(environ, entity):
+    if entity is None:
+        return []
+    if type(entity) is str:
+        return [entity]
+    if hasattr(entity, 'read'):
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper:
+            return file_wrapper(entity, chunk_size)
+        return iter_file(entity)
+    return entity
+
+
+
+###########################################################################
+# Compression (gzip) of the responses
+###########################################################################
+class Compression(object):
+    """The responses of the given content types, and bigger than min_size
+    bytes, are compressed if the client accepts gzip. The level goes from 1
+    to 9, zero disables the compression.
+    """
+
+    level = 0
+    min_size = 1024
+    types = frozenset()
+
+
+    def configure(self, level, min_size, types):
+        self.level = level
+        self.min_size = min_size
+        self.types = frozenset(types)
+
+
+    def accepts_gzip(self, environ):
+        accept = environ.get('HTTP_ACCEPT_ENCODING') or ''
+        for value in accept.split(','):
+            coding, sep, parameters = value.partition(';')
+            if coding.strip().lower() != 'gzip':
+                continue
+            parameters = parameters.strip()
+            if parameters.startswith('q='):
+                try:
+                    return float(parameters[2:]) > 0
+                except ValueError:
+                    return False
+            return True
+        return False
+
+
+    def compress(self, environ, status, headers, entity):
+        """Return the tuple (headers, entity), compressed if possible. The
+        headers given are not modified (they may come from the page cache).
+        """
+        if not self.level or entity is None:
+            return headers, entity
+        code = int(status[:3])
+        if code < 200 or code in (204, 206, 304):
+            return headers, entity
+
+        names = dict([ (x.lower(), y) for x, y in headers ])
+        if 'content-encoding' in names or 'content-range' in names:
+            return headers, entity
+        content_type = names.get('content-type', '').split(';')[0].strip()
+        if content_type not in self.types:
+            return headers, entity
+
+        # The response depends on Accept-Encoding
+        headers = [ x for x in headers if x[0].lower() != 'vary' ]
+        vary = names.get('vary')
+        headers.append(('Vary',
+                        '%s, Accept-Encoding' % vary if vary
+                        else 'Accept-Encoding'))
+        if not self.accepts_gzip(environ):
+            return headers, entity
+        length = get_content_length(entity)
+        if length is not None and length < self.min_size:
+            return headers, entity
+
+        # Compress. The byte ranges are those of the uncompressed body, they
+        # are not offered for the compressed one, and its entity tag is weak
+        # (so If-Range does not match it)
+        headers = [ x for x in headers
+                    if x[0].lower() not in ('content-length', 'accept-ranges') ]
+        etag = names.get('etag')
+        if etag and not etag.startswith('W/'):
+            headers = [ x for x in headers if x[0].lower() != 'etag' ]
+            headers.append(('ETag', 'W/%s' % etag))
+        headers.append(('Content-Encoding', 'gzip'))
+        if type(entity) is str:
+            entity = self.gzip(entity)
+            headers.append(('Content-Length', str(len(entity))))
+        elif hasattr(entity, 'read'):
+            entity = self.iter_gzip(iter_file(entity))
+        else:
+            entity = self.iter_gzip(entity)
+        return headers, entity
+
+
+    def get_compressor(self):
+        # wbits=31 for the gzip format
+        return zlib.compressobj(self.level, zlib.DEFLATED, 31)
+
+
+    def gzip(self, data):
+        compressor = self.get_compressor()
+        return compressor.compress(data) + compressor.flush()
+
+
+    def iter_gzip(self, chunks):
+        compressor = self.get_compressor()
+        try:
+            for data in chunks:
+                data = compressor.compress(data)
+                if data:
+                    yield data
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+        yield compressor.flush()
+
+
+
+compression = Compression()
+
+
+
+###########################################################################
+# Pre-fork mode: read-only workers forward unsafe requests to the writer
+###########################################################################
+hop_by_hop_headers = frozenset(['connection', 'keep-alive', 'te',
+                                'trailers', 'transfer-encoding', 'upgrade'])
+
+
+class WriterConnection(HTTPConnection):
+    """HTTP connection to the writer process, through its unix socket.
+    """
+
+    def __init__(self, path):
+        HTTPConnection.__init__(self, 'localhost')
+        self.path = path
+
+
+    def connect(self):
+        self.sock = socket(AF_UNIX, SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+
+def forward_to_writer(environ, start_response):
+    from ikaaro.server import get_server
+    server = get_server()
+    # Request line
+    path = environ.get('PATH_INFO', '/')
+    query = environ.get('QUERY_STRING')
+    if query:
+        path = '%s?%s' % (path, query)
+    # Headers
+    headers = {}
+    for name, value in environ.iteritems():
+        if name.startswith('HTTP_'):
+            name = name[5:].replace('_', '-').title()
+            if name.lower() not in hop_by_hop_headers:
+                headers[name] = value
+    if environ.get('CONTENT_TYPE'):
+        headers['Content-Type'] = environ['CONTENT_TYPE']
+    if 'X-Forwarded-For' not in headers and environ.get('REMOTE_ADDR'):
+        headers['X-Forwarded-For'] = environ['REMOTE_ADDR']
+    length = int(environ.get('CONTENT_LENGTH') or 0)
+    if environ.get('CONTENT_LENGTH'):
+        headers['Content-Length'] = str(length)
+    # Forward (the body of the request and of the response are copied by
+    # chunks, they are not kept in memory)
+    connection = WriterConnection(server.writer_address)
+    try:
+        try:
+            names = set([ x.lower() for x in headers ])
+            connection.putrequest(environ['REQUEST_METHOD'], path,
+                skip_host='host' in names,
+                skip_accept_encoding='accept-encoding' in names)
+            for name, value in headers.iteritems():
+                connection.putheader(name, value)
+            connection.endheaders()
+            input = environ['wsgi.input']
+            while length > 0:
+                data = input.read(min(chunk_size, length))
+                if not data:
+                    break
+                connection.send(data)
+                length -= len(data)
+            response = connection.getresponse()
+        except Exception:
+            log_error('Cannot forward request to the writer',
+                      domain='itools.web')
+            start_response('503 %s' % reason_phrases[503],
+                           [('Content-Type', 'text/plain')])
+            yield '503 %s' % reason_phrases[503]
+            return
+        # Response (keep repeated headers like Set-Cookie)
+        response_headers = []
+        for line in response.msg.headers:
+            if line[0] in ' \t' and response_headers:
+                name, value = response_headers.pop()
+                value = '%s %s' % (value, line.strip())
+                response_headers.append((name, value))
+                continue
+            name, value = line.split(':', 1)
+            if name.lower() not in hop_by_hop_headers:
+                response_headers.append((name, value.strip()))
+        status = '%s %s' % (response.status, response.reason)
+        start_response(status, response_headers)
+        while True:
+            data = response.read(chunk_size)
+            if not data:
+                break
+            yield data
+    finally:
+        connection.close()
+
+
+
+def worker_application(environ, start_response):
+    """WSGI application of the read-only workers.
+    """
+    if environ.get('REQUEST_METHOD') in safe_methods:
+        return application(environ, start_response)
+    return forward_to_writer(environ, start_response)
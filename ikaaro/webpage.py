@@ -34,6 +34,7 @@ class WebPage_View(BaseView):
     access = 'is_allowed_to_view'
     title = MSG(u'View')
     icon = 'view.png'
+    cacheable = True
 
 
     def GET(self, resource, context):
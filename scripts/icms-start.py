@@ -26,7 +26,7 @@ from xapian import DatabaseLockError
 from itools import __version__
 
 # Import from ikaaro
-from ikaaro.server import Server
+from ikaaro.server import Server, start_workers
 
 if __name__ == '__main__':
     # The command line parser
@@ -45,6 +45,11 @@ if __name__ == '__main__':
     parser.add_option(
         '-p', '--port', default=None,
         help="Start the server on this port")
+    parser.add_option(
+        '-w', '--workers', type='int', default=0,
+        help="Start WORKERS read-only processes to serve the GET and HEAD "
+             "requests, the other requests are forwarded to a single "
+             "read-write process.")
     parser.add_option(
         '--quick', action="store_true", default=False,
         help="Do not check the database consistency.")
@@ -62,6 +67,14 @@ if __name__ == '__main__':
         parser.error('Wrong number of arguments.')
     # Get target
     target = args[0]
+    # Pre-fork mode
+    if options.workers:
+        if options.read_only:
+            parser.error('--workers cannot be used with --read-only.')
+        successfully_started = start_workers(
+            target, options.workers, port=options.port,
+            detach=options.detach, profile=options.profile_time)
+        exit(0 if successfully_started else 1)
     # Set-up the server
     try:
         server = Server(target, read_only=options.read_only,
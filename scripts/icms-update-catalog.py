@@ -48,7 +48,8 @@ def update_catalog(parser, options, target):
     server.reindex_catalog(
         as_test=options.test,
         quiet=options.quiet,
-        quick=options.quick)
+        quick=options.quick,
+        jobs=options.jobs)
 
 
 
@@ -74,6 +75,9 @@ if __name__ == '__main__':
         help="do not check the database consistency.")
     parser.add_option('-t', '--test', action='store_true', default=False,
         help="a test mode, don't stop the indexation when an error occurs")
+    parser.add_option('-j', '--jobs', type='int', default=1,
+        help="the number of processes computing the values to index"
+             " (default 1)")
 
     options, args = parser.parse_args()
     if len(args) != 1:
@@ -17,15 +17,28 @@
 # Import from the Standard Library
 from unittest import TestCase, main
 from datetime import time
+from os.path import dirname, join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+# Import from gevent
+from gevent import sleep, spawn
 
 # Import from itools
 from itools.database import AndQuery, PhraseQuery
 
 # Import from ikaaro
-from ikaaro.database import Database
+import ikaaro
+import ikaaro.database as database_module
+from ikaaro.config_access import AccessRule, rules_queries
+from ikaaro.database import Database, DatabaseLock, OnchangeIndex
+from ikaaro.file import Image
 from ikaaro.folder import Folder
+from ikaaro.resource_ import IndexingCache, get_catalog_digest
+from ikaaro.server import get_shard_resources
 from ikaaro.utils import get_base_path_query
 from ikaaro.text import Text
+from ikaaro.thumbnails import thumbnails
 
 
 class FreeTestCase(TestCase):
@@ -201,6 +214,315 @@ class FreeTestCase(TestCase):
                 database.close()
 
 
+    def test_resources_map(self):
+        with Database('demo.hforge.org', 19500, 20500) as database:
+            with database.init_context():
+                root = database.get_resource('/')
+                container = root.make_resource('test-map', Folder)
+                container.make_resource('hello.txt', Text)
+                # Same path, same instance
+                resource = root.get_resource('/test-map/hello.txt')
+                self.assertIs(root.get_resource('test-map/hello.txt'),
+                              resource)
+                self.assertIs(resource.parent,
+                              root.get_resource('/test-map'))
+                # Move
+                root.move_resource('test-map', 'test-map2')
+                self.assertEqual(
+                    root.get_resource('/test-map/hello.txt', soft=True), None)
+                resource = root.get_resource('/test-map2/hello.txt')
+                self.assertEqual(str(resource.abspath), '/test-map2/hello.txt')
+                # Delete
+                root.del_resource('test-map2')
+                self.assertEqual(
+                    root.get_resource('/test-map2/hello.txt', soft=True), None)
+                # The commit clears the map
+                resource = root.make_resource('test-map3', Text)
+                self.assertIs(root.get_resource('test-map3'), resource)
+                database.save_changes()
+                self.assertEqual(
+                    '/test-map3' in database.get_resources_map(), False)
+                # The size is bounded
+                database.resources_map_size = 1
+                root.get_resource('test-map3')
+                self.assertEqual(len(database.get_resources_map()), 1)
+                root.get_resource('config')
+                self.assertEqual(len(database.get_resources_map()), 1)
+                del database.resources_map_size
+                root.del_resource('test-map3')
+                database.close()
+
+
+    def test_values_cache(self):
+        with Database('demo.hforge.org', 19500, 20500) as database:
+            with database.init_context():
+                root = database.get_resource('/')
+                resource = root.make_resource('test-values', Text)
+                resource.set_value('title', u'Hello', language='en')
+                # Count the reads of the metadata
+                metadata = resource.metadata
+                calls = []
+                get_property = metadata.get_property
+                def counter(*args, **kw):
+                    calls.append(args)
+                    return get_property(*args, **kw)
+                metadata.get_property = counter
+                # Repeated reads
+                for i in range(10):
+                    title = resource.get_value('title', language='en')
+                    self.assertEqual(title, u'Hello')
+                self.assertEqual(len(calls), 1)
+                # Lists are copied
+                resource.get_value('share').append('everybody')
+                self.assertEqual(resource.get_value('share'), [])
+                # Set value
+                resource.set_value('title', u'Bye', language='en')
+                del calls[:]
+                title = resource.get_value('title', language='en')
+                self.assertEqual(title, u'Bye')
+                self.assertEqual(len(calls), 1)
+                # Abort
+                database.abort_changes()
+                del calls[:]
+                resource.get_value('title', language='en')
+                self.assertEqual(len(calls), 1)
+                del metadata.get_property
+                database.close()
+
+
+    def test_database_lock(self):
+        lock = DatabaseLock()
+        # Any number of readers
+        lock.acquire(shared=True)
+        lock.acquire(shared=True)
+        self.assertEqual(lock.readers, 2)
+        # The writer waits for the readers
+        writer = spawn(lock.acquire)
+        sleep(0)
+        self.assertFalse(writer.ready())
+        # The readers that come after the writer wait too
+        reader = spawn(lock.acquire, True)
+        sleep(0)
+        self.assertFalse(reader.ready())
+        lock.release(shared=True)
+        lock.release(shared=True)
+        writer.join()
+        self.assertFalse(reader.ready())
+        # Once the writer is done, the reader goes on
+        lock.release()
+        reader.join()
+        self.assertEqual(lock.readers, 1)
+        lock.release(shared=True)
+        self.assertEqual(lock.readers, 0)
+
+
+    def test_rules_queries(self):
+        with Database('demo.hforge.org', 19500, 20500) as database:
+            with database.init_context():
+                access = database.get_resource('/config/access')
+                groups = ['/config/groups/test-rules']
+                key = (frozenset(groups), 'view', None)
+                query = access.get_rules_query(groups, 'view')
+                self.assertEqual(len(query.atoms), 0)
+                self.assertNotEqual(rules_queries.get(key), None)
+                # The rules not committed are not cached
+                rule = access.make_resource(None, AccessRule, group=groups[0])
+                rule.set_value('permission', 'view')
+                query = access.get_rules_query(groups, 'view')
+                self.assertEqual(len(query.atoms), 1)
+                self.assertEqual(len(rules_queries.get(key).atoms), 0)
+                # Abort
+                database.abort_changes()
+                self.assertEqual(rules_queries.get(key), None)
+                query = access.get_rules_query(groups, 'view')
+                self.assertEqual(len(query.atoms), 0)
+                database.close()
+
+
+    def test_thumbnails(self):
+        images = join(dirname(ikaaro.__file__), 'ui/aruni/images')
+        with open(join(images, 'ikaaro_powered.png')) as f:
+            data1 = f.read()
+        with open(join(images, 'sprite_sort.png')) as f:
+            data2 = f.read()
+        folder = mkdtemp()
+        thumbnails.configure(folder, 1024 * 1024)
+        stats = thumbnails.stats
+        try:
+            with Database('demo.hforge.org', 19500, 20500) as database:
+                with database.init_context():
+                    root = database.get_resource('/')
+                    image = root.make_resource('test-thumbnails', Image,
+                                               data=data1)
+                    database.save_changes()
+                    handler = image.get_value('data')
+                    thumb = thumbnails.get_thumbnail(handler, 16, 16, 'png')
+                    hit = stats['hit']
+                    self.assertEqual(
+                        thumbnails.get_thumbnail(handler, 16, 16, 'png'),
+                        thumb)
+                    self.assertEqual(stats['hit'], hit + 1)
+                    # Replace the image: the old thumbnail is not served
+                    image.set_value('data', data2)
+                    database.save_changes()
+                    handler = image.get_value('data')
+                    miss = stats['miss']
+                    new_thumb = thumbnails.get_thumbnail(handler, 16, 16,
+                                                         'png')
+                    self.assertEqual(stats['miss'], miss + 1)
+                    self.assertNotEqual(new_thumb, thumb)
+                    root.del_resource('test-thumbnails')
+                    database.close()
+        finally:
+            thumbnails.configure(None, 0)
+            rmtree(folder)
+
+
+    def test_onchange_index(self):
+        index = OnchangeIndex()
+        index.update([('/b', ['/a']), ('/c', ['/b']), ('/d', None)], [])
+        self.assertEqual(index.get_sources(['/a']), set(['/b']))
+        self.assertEqual(index.get_sources(['/a', '/b']), set(['/b', '/c']))
+        # Change the dependencies
+        index.update([('/c', ['/a'])], [])
+        self.assertEqual(index.get_sources(['/a']), set(['/b', '/c']))
+        self.assertEqual(index.get_sources(['/b']), set())
+        # Unindex
+        index.update([], ['/b'])
+        self.assertEqual(index.get_sources(['/a']), set(['/c']))
+
+
+    def test_indexing_cache(self):
+        with Database('demo.hforge.org', 19500, 20500) as database:
+            with database.init_context() as context:
+                root = database.get_resource('/')
+                container = root.make_resource('test-indexing', Folder)
+                a = container.make_resource('a', Text)
+                b = container.make_resource('b', Text)
+                expected = a.get_catalog_values()
+                # Same values, the plan of the fields is made once by class
+                indexing = IndexingCache(root)
+                context.indexing = indexing
+                self.assertEqual(a.get_catalog_values(), expected)
+                b.get_catalog_values()
+                self.assertEqual(indexing.fields.keys(), [Text])
+                self.assertIs(indexing.get_fields(a), indexing.get_fields(b))
+                context.indexing = None
+                database.close()
+
+
+    def test_catalog_digest(self):
+        a = {'title': {'en': u'Hello', 'fr': u'Bonjour'},
+             'next_time_event_payload': None}
+        b = {'next_time_event_payload': None,
+             'title': {'fr': u'Bonjour', 'en': u'Hello'}}
+        self.assertEqual(get_catalog_digest(a), get_catalog_digest(b))
+        b['title']['fr'] = u'Salut'
+        self.assertNotEqual(get_catalog_digest(a), get_catalog_digest(b))
+        b['title']['fr'] = u'Bonjour'
+        b['next_time_event_payload'] = 'payload'
+        self.assertNotEqual(get_catalog_digest(a), get_catalog_digest(b))
+        # Unchanged documents are not indexed again
+        with Database('demo.hforge.org', 19500, 20500) as database:
+            with database.init_context():
+                root = database.get_resource('/')
+                resource = root.make_resource('test-digest', Text)
+                database.save_changes()
+                path = str(resource.abspath)
+                digests = database.get_catalog_digests([path])
+                resource.reindex()
+                database.save_changes()
+                self.assertEqual(database.get_catalog_digests([path]), digests)
+                root.del_resource('test-digest')
+                database.save_changes()
+                database.close()
+
+
+    def test_group_commit(self):
+        with Database('demo.hforge.org', 19500, 20500) as database:
+            database.group_window = 60
+            results = []
+            for name in 'test-group-1', 'test-group-2':
+                with database.init_context(commit_at_exit=False) as context:
+                    context.group_commit = True
+                    root = database.get_resource('/')
+                    root.make_resource(name, Text)
+                    database.save_changes()
+                    results.append(context.group_commit)
+            # Not saved yet
+            self.assertEqual(len(database.group), 2)
+            self.assertFalse(results[0].ready())
+            # Save
+            database.flush_group()
+            self.assertEqual(database.group, [])
+            for result in results:
+                self.assertTrue(result.successful())
+            with database.init_context():
+                root = database.get_resource('/')
+                self.assertNotEqual(root.get_resource('test-group-1'), None)
+                self.assertNotEqual(root.get_resource('test-group-2'), None)
+                root.del_resource('test-group-1')
+                root.del_resource('test-group-2')
+            database.group_window = 0
+            database.close()
+
+
+    def test_group_commit_abort(self):
+        warnings = []
+        log_warning = database_module.log_warning
+        database_module.log_warning = lambda *args, **kw: warnings.append(args)
+        with Database('demo.hforge.org', 19500, 20500) as database:
+            database.group_window = 60
+            try:
+                with database.init_context(commit_at_exit=False) as context:
+                    context.group_commit = True
+                    root = database.get_resource('/')
+                    root.make_resource('test-group-abort-1', Text)
+                    database.save_changes()
+                    result = context.group_commit
+                # No warning for the changes kept for the group
+                self.assertEqual(warnings, [])
+                # Abort without changes: the group is kept
+                with database.init_context(commit_at_exit=False):
+                    database.abort_changes()
+                self.assertEqual(len(database.group), 1)
+                # A read-only context waits for the group to be saved
+                def read():
+                    with database.init_context(read_only=True):
+                        root = database.get_resource('/')
+                        resource = root.get_resource('test-group-abort-1',
+                                                     soft=True)
+                        return resource is not None
+                reader = spawn(read)
+                sleep(0)
+                self.assertFalse(reader.ready())
+                # Abort with changes: the requests of the group fail
+                with database.init_context(commit_at_exit=False):
+                    root = database.get_resource('/')
+                    root.make_resource('test-group-abort-2', Text)
+                    database.abort_changes()
+                self.assertEqual(database.group, [])
+                self.assertEqual(result.successful(), False)
+                self.assertEqual(reader.get(), False)
+            finally:
+                database.group_window = 0
+                database_module.log_warning = log_warning
+            database.close()
+
+
+    def test_shard_resources(self):
+        with Database('demo.hforge.org', 19500, 20500) as database:
+            with database.init_context():
+                root = database.get_resource('/')
+                expected = [ str(x.abspath) for x in root.traverse_resources() ]
+                # Every resource is in one shard
+                paths = []
+                for shard in range(3):
+                    resources = get_shard_resources(root, shard, 3)
+                    paths.extend([ str(x.abspath) for x in resources ])
+                self.assertEqual(sorted(paths), sorted(expected))
+
+
     def test_set_bad_value(self):
         with Database('demo.hforge.org', 19500, 20500) as database:
             with database.init_context():
@@ -233,6 +555,27 @@ class FreeTestCase(TestCase):
                 database.close()
 
 
+    def test_failed_commit(self):
+        with Database('demo.hforge.org', 19500, 20500) as database:
+            with database.init_context():
+                root = database.get_resource('/')
+                calls = []
+                root.make_resource('test-failed-commit', Text)
+                database.call_after_commit(calls.append, 'failed')
+                def before_commit():
+                    raise RuntimeError('failed commit')
+                database._before_commit = before_commit
+                self.assertRaises(RuntimeError, database.save_changes)
+                del database._before_commit
+                # The callbacks of the failed transaction are dropped
+                root.make_resource('test-failed-commit', Text)
+                database.call_after_commit(calls.append, 'ok')
+                database.save_changes()
+                self.assertEqual(calls, ['ok'])
+                root.del_resource('test-failed-commit')
+                database.close()
+
+
     def test_close_transaction(self):
         """
         Test if flush is done when we close database
@@ -15,16 +15,46 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from the Standard Library
+from datetime import datetime, timedelta
+from os import waitpid, WNOHANG
+from shutil import rmtree
 from StringIO import StringIO
+from tempfile import mkdtemp, TemporaryFile
+from time import time
 from unittest import TestCase, main
+from wsgiref.util import setup_testing_defaults
+import zlib
+
+# Import from gevent
+from gevent import getcurrent, sleep
+from gevent.pywsgi import WSGIServer
 
 # Import from itools
-from itools.database import PhraseQuery
-from itools.datatypes import String, Unicode
+from itools.core import local_tz
+from itools.database import AndQuery, OrQuery, PhraseQuery
+from itools.datatypes import HTTPDate, String, Unicode
+from itools.web import NotModified
 from itools.web.views import ItoolsView, BaseView
 
 # Import from ikaaro
-from ikaaro.server import Server
+import ikaaro.server as server_module
+from ikaaro.assets import StaticAsset, minify_css, static_assets
+from ikaaro.config_access import AccessRule, match_view_rule
+from ikaaro.context import auth_cache
+from ikaaro.database import greenlet_contexts
+from ikaaro.file import File
+from ikaaro.folder import Folder
+from ikaaro.server import Server, make_listener
+from ikaaro.skins import skin_registry
+from ikaaro.templates import template_registry
+from ikaaro.text import Text
+from ikaaro.utils import check_conditional_get, fragment_cache
+from ikaaro.utils import get_fragment
+from ikaaro.web import multipart
+from ikaaro.web.wsgi import Compression, chunk_size, get_body
+from ikaaro.web.wsgi import get_content_length
+from ikaaro.web.wsgi import get_response, page_cache, read_upload
+from ikaaro.web.wsgi import worker_application
 
 
 class TestHTML_View(ItoolsView):
@@ -47,6 +77,28 @@ class TestPlainText_View(ItoolsView):
 
 
 
+class TestCached_View(ItoolsView):
+
+    access = True
+    known_methods = ['GET']
+    cacheable = True
+    calls = []
+
+    def GET(self, resource, context):
+        self.calls.append(1)
+        context.set_content_type('text/plain')
+        return 'hello world'
+
+
+
+class TestCookie_View(TestCached_View):
+
+    def GET(self, resource, context):
+        context.set_cookie('test', 'hello')
+        return super(TestCookie_View, self).GET(resource, context)
+
+
+
 class TestJson_View(ItoolsView):
 
     access = True
@@ -79,6 +131,29 @@ class TestJsonAction_View(BaseView):
 
 
 
+def get_environ(path, **kw):
+    environ = {'PATH_INFO': path, 'REQUEST_METHOD': 'GET',
+               'QUERY_STRING': ''}
+    setup_testing_defaults(environ)
+    environ.update(kw)
+    return environ
+
+
+
+def make_test_file(server, name, data):
+    """Make a file everybody can view, and return its path.
+    """
+    with server.database.init_context() as context:
+        theme = context.root.get_resource('/config/theme')
+        if theme.get_resource(name, soft=True) is not None:
+            theme.del_resource(name)
+        resource = theme.make_resource(name, File, data=data,
+                                       filename='%s.txt' % name)
+        resource.set_value('share', ['everybody'])
+        return str(resource.abspath)
+
+
+
 class ServerTestCase(TestCase):
 
 
@@ -106,6 +181,434 @@ class ServerTestCase(TestCase):
                 self.assertEqual(retour['entity']['up'], True)
 
 
+    def test_catalog_reopen(self):
+        with Server('demo.hforge.org') as server:
+            with server.database.init_context():
+                server.do_request('GET', '/api/status', as_json=True)
+                stats = server.get_stats()['catalog_reopen']
+                hit, miss = stats['hit'], stats['miss']
+                # No commit: the catalog is not reopened
+                server.do_request('GET', '/api/status', as_json=True)
+                self.assertEqual(stats['hit'], hit + 1)
+                self.assertEqual(stats['miss'], miss)
+
+
+    def test_concurrent_readers(self):
+        with Server('demo.hforge.org') as server:
+            concurrent_readers = server.concurrent_readers
+            server.concurrent_readers = True
+            database = server.database
+            try:
+                with database.init_context(read_only=True) as context:
+                    self.assertEqual(context.read_only, True)
+                    self.assertIs(greenlet_contexts[getcurrent()], context)
+                    # The changes of a shared context are aborted
+                    root = database.get_resource('/')
+                    title = root.get_value('title', language='fr')
+                    root.set_value('title', u'Read only', language='fr')
+                    database.save_changes()
+                    self.assertEqual(database.has_changed, False)
+                    self.assertEqual(root.get_value('title', language='fr'),
+                                     title)
+                self.assertEqual(getcurrent() in greenlet_contexts, False)
+                # Not shared
+                with database.init_context() as context:
+                    self.assertEqual(context.read_only, False)
+            finally:
+                server.concurrent_readers = concurrent_readers
+
+
+    def test_catalog_values(self):
+        with Server('demo.hforge.org') as server:
+            database = server.database
+            root = server.root
+            values = server.iter_catalog_values(database, root,
+                                                root.traverse_resources(),
+                                                True)
+            # The resources are not kept in the identity map
+            for n, x in enumerate(values):
+                self.assertEqual(database.get_resources_map(), None)
+                if n == 20:
+                    break
+            values.close()
+
+
+    def test_static_assets(self):
+        with Server('demo.hforge.org') as server:
+            with server.database.init_context():
+                stats = server.get_stats()['static']
+                hit = stats['hit']
+                retour = server.do_request('GET', '/ui/ikaaro/javascript.js')
+                self.assertEqual(retour['status'], 200)
+                self.assertEqual(stats['hit'], hit + 1)
+                path = '%s/javascript.js' % skin_registry['ikaaro'].key
+                with open(path) as f:
+                    self.assertEqual(retour['entity'], f.read())
+                # The files not kept in memory are not compressed
+                asset = static_assets.set('/ui/ikaaro/test.js', path,
+                                          'hello world ' * 100,
+                                          'application/javascript')
+                self.assertEqual(asset.gzip, None)
+                self.assertEqual(static_assets.get('/ui/ikaaro/test.js'),
+                                 None)
+                asset = static_assets.set('/ui/ikaaro/javascript.js', path,
+                                          'hello world ' * 100,
+                                          'application/javascript')
+                self.assertNotEqual(asset.gzip, None)
+                static_assets.assets.pop('/ui/ikaaro/javascript.js')
+
+
+    def test_page_cache(self):
+        with Server('demo.hforge.org') as server:
+            server.dispatcher.add('/test/cached', TestCached_View)
+            server.dispatcher.add('/test/cookie', TestCookie_View)
+            size = server.config.get_value('page-cache-size')
+            ttl, stale = page_cache.ttl, page_cache.stale
+            calls = TestCached_View.calls
+            page_cache.configure(size, 60, 0)
+            try:
+                # Hit
+                del calls[:]
+                for i in range(2):
+                    status, headers, entity = get_response(
+                        get_environ('/test/cached'))
+                    self.assertEqual(status, '200 OK')
+                    self.assertEqual(entity, 'hello world')
+                self.assertEqual(len(calls), 1)
+                # Every page depends on the root
+                with server.database.init_context() as context:
+                    context.root.set_value('title', u'Cache', language='fr')
+                get_response(get_environ('/test/cached'))
+                self.assertEqual(len(calls), 2)
+                # The responses that set a cookie are not kept
+                del calls[:]
+                for i in range(2):
+                    get_response(get_environ('/test/cookie'))
+                self.assertEqual(len(calls), 2)
+                # Stale while revalidate
+                page_cache.configure(size, 60, 60)
+                del calls[:]
+                get_response(get_environ('/test/cached'))
+                for key in page_cache.values.keys():
+                    response, depends, expires = page_cache.values[key]
+                    page_cache.set(key, response, depends, time() - 1)
+                stale_hits = page_cache.stats['stale']
+                status, headers, entity = get_response(
+                    get_environ('/test/cached'))
+                self.assertEqual(entity, 'hello world')
+                self.assertEqual(page_cache.stats['stale'], stale_hits + 1)
+                self.assertEqual(len(calls), 1)
+                # Computed again in the background
+                sleep(0.1)
+                self.assertEqual(len(calls), 2)
+                get_response(get_environ('/test/cached'))
+                self.assertEqual(len(calls), 2)
+            finally:
+                page_cache.configure(size, ttl, stale)
+
+
+    def test_conditional_get(self):
+        with Server('demo.hforge.org') as server:
+            with server.database.init_context() as context:
+                # Naive times are local times
+                mtime = datetime(2020, 1, 1, 12, 0, 0)
+                since = HTTPDate.encode(local_tz.localize(mtime))
+                before = mtime - timedelta(seconds=1)
+                before = HTTPDate.encode(local_tz.localize(before))
+                context.environ = {'HTTP_IF_MODIFIED_SINCE': since}
+                self.assertRaises(NotModified, check_conditional_get,
+                                  context, '"a"', mtime)
+                context.environ = {'HTTP_IF_MODIFIED_SINCE': before}
+                check_conditional_get(context, '"a"', mtime)
+                # If-None-Match has precedence over If-Modified-Since
+                context.environ = {'HTTP_IF_NONE_MATCH': '"b", W/"a"',
+                                   'HTTP_IF_MODIFIED_SINCE': before}
+                self.assertRaises(NotModified, check_conditional_get,
+                                  context, '"a"', mtime)
+                context.environ = {'HTTP_IF_NONE_MATCH': '"b"',
+                                   'HTTP_IF_MODIFIED_SINCE': since}
+                check_conditional_get(context, '"a"', mtime)
+
+
+    def test_rest_read_etag(self):
+        with Server('demo.hforge.org') as server:
+            path = make_test_file(server, 'test-rest-etag', 'hello world')
+            def request(**kw):
+                environ = get_environ('%s/;rest_read' % path, **kw)
+                status, headers, entity = get_response(environ)
+                return status[:3], dict(headers), entity
+            status, headers, entity = request()
+            self.assertEqual(status, '200')
+            etag = headers['ETag']
+            # Not modified
+            status, headers, entity = request(HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(status, '304')
+            self.assertEqual(entity, None)
+            # The file changes, not the metadata
+            with server.database.init_context() as context:
+                resource = context.root.get_resource(path)
+                resource.set_value('data', 'hello world again')
+            status, headers, entity = request(HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(status, '200')
+            self.assertNotEqual(headers['ETag'], etag)
+
+
+    def test_file_body(self):
+        data = 'hello world\n' * 20000
+        # Files are sent by chunks
+        file = TemporaryFile()
+        file.write(data)
+        file.seek(0)
+        self.assertEqual(get_content_length(file), len(data))
+        chunks = list(get_body({}, file))
+        self.assertEqual(''.join(chunks), data)
+        self.assertEqual(len(chunks) > 1, True)
+        self.assertEqual(file.closed, True)
+        # Or given to the file wrapper of the server
+        file = TemporaryFile()
+        file.write(data)
+        file.seek(0)
+        wrapped = []
+        def file_wrapper(file, size):
+            wrapped.append(size)
+            return iter(lambda: file.read(size), '')
+        environ = {'wsgi.file_wrapper': file_wrapper}
+        self.assertEqual(''.join(get_body(environ, file)), data)
+        self.assertEqual(wrapped, [chunk_size])
+        # A file of the database is streamed from the disk
+        with Server('demo.hforge.org') as server:
+            path = make_test_file(server, 'test-stream', data)
+            environ = get_environ('%s/;get_file' % path,
+                                  QUERY_STRING='name=data')
+            status, headers, entity = get_response(environ)
+            self.assertEqual(status, '200 OK')
+            self.assertEqual(hasattr(entity, 'read'), True)
+            self.assertEqual(dict(headers)['Content-Length'], str(len(data)))
+            self.assertEqual(''.join(get_body({}, entity)), data)
+
+
+    def test_ranges(self):
+        data = ''.join([ '%05d' % i for i in range(1000) ])
+        with Server('demo.hforge.org') as server:
+            path = make_test_file(server, 'test-ranges', data)
+            def request(**kw):
+                environ = get_environ('%s/;get_file' % path,
+                                      QUERY_STRING='name=data', **kw)
+                status, headers, entity = get_response(environ)
+                body = ''.join(get_body({}, entity))
+                return status[:3], dict(headers), body
+            # One range
+            status, headers, body = request(HTTP_RANGE='bytes=10-19')
+            self.assertEqual(status, '206')
+            self.assertEqual(body, data[10:20])
+            self.assertEqual(headers['Content-Range'], 'bytes 10-19/5000')
+            self.assertEqual(headers['Content-Length'], '10')
+            status, headers, body = request(HTTP_RANGE='bytes=-10')
+            self.assertEqual(body, data[-10:])
+            # Several ranges
+            status, headers, body = request(HTTP_RANGE='bytes=0-4,100-104')
+            self.assertEqual(status, '206')
+            content_type = headers['Content-Type']
+            self.assertEqual(content_type.startswith('multipart/byteranges'),
+                             True)
+            self.assertEqual(len(body), int(headers['Content-Length']))
+            self.assertEqual(data[0:5] in body, True)
+            self.assertEqual(data[100:105] in body, True)
+            self.assertEqual('Content-Range: bytes 100-104/5000' in body,
+                             True)
+            # If-Range
+            etag = headers['ETag']
+            status, headers, body = request(HTTP_RANGE='bytes=10-19',
+                                            HTTP_IF_RANGE=etag)
+            self.assertEqual(status, '206')
+            self.assertEqual(body, data[10:20])
+            status, headers, body = request(HTTP_RANGE='bytes=10-19',
+                                            HTTP_IF_RANGE='"changed"')
+            self.assertEqual(status, '200')
+            self.assertEqual(body, data)
+            # Not satisfiable
+            status, headers, body = request(HTTP_RANGE='bytes=6000-7000')
+            self.assertEqual(status, '416')
+            self.assertEqual(headers['Content-Range'], 'bytes */5000')
+
+
+    def test_compression(self):
+        compression = Compression()
+        compression.configure(6, 100, ['text/html'])
+        data = 'hello world ' * 100
+        headers = [('Content-Type', 'text/html; charset=UTF-8'),
+                   ('Content-Length', str(len(data)))]
+        gzip = {'HTTP_ACCEPT_ENCODING': 'deflate, gzip'}
+        # Compressed
+        new_headers, entity = compression.compress(gzip, '200 OK', headers,
+                                                   data)
+        names = dict(new_headers)
+        self.assertEqual(names['Content-Encoding'], 'gzip')
+        self.assertEqual(names['Content-Length'], str(len(entity)))
+        self.assertEqual(names['Vary'], 'Accept-Encoding')
+        self.assertEqual(zlib.decompress(entity, 31), data)
+        self.assertEqual(len(headers), 2)
+        # Files are compressed by chunks
+        file = TemporaryFile()
+        file.write(data)
+        file.seek(0)
+        new_headers, entity = compression.compress(gzip, '200 OK', headers,
+                                                   file)
+        self.assertEqual('Content-Length' in dict(new_headers), False)
+        self.assertEqual(zlib.decompress(''.join(entity), 31), data)
+        # Not accepted
+        for accept in ['gzip;q=0', 'gzip; q=0.0', 'deflate', '']:
+            environ = {'HTTP_ACCEPT_ENCODING': accept}
+            new_headers, entity = compression.compress(environ, '200 OK',
+                                                       headers, data)
+            self.assertEqual(entity, data)
+            self.assertEqual(dict(new_headers)['Vary'], 'Accept-Encoding')
+        self.assertEqual(compression.accepts_gzip(
+            {'HTTP_ACCEPT_ENCODING': 'gzip;q=0.5'}), True)
+        # Too small
+        new_headers, entity = compression.compress(gzip, '200 OK', headers,
+                                                   'hello')
+        self.assertEqual(entity, 'hello')
+        # Partial content and not modified
+        for status in ['206 Partial Content', '304 Not Modified']:
+            new_headers, entity = compression.compress(gzip, status, headers,
+                                                       data)
+            self.assertEqual(entity, data)
+            self.assertEqual(new_headers, headers)
+        # Other types
+        png = [('Content-Type', 'image/png')]
+        new_headers, entity = compression.compress(gzip, '200 OK', png, data)
+        self.assertEqual(entity, data)
+        # Merge the Vary header
+        vary = headers + [('Vary', 'Cookie')]
+        new_headers, entity = compression.compress(gzip, '200 OK', vary, data)
+        values = [ y for x, y in new_headers if x.lower() == 'vary' ]
+        self.assertEqual(values, ['Cookie, Accept-Encoding'])
+        # The byte ranges are not offered for the compressed body
+        ranges = headers + [('Accept-Ranges', 'bytes'), ('ETag', '"a"')]
+        new_headers, entity = compression.compress(gzip, '200 OK', ranges,
+                                                   data)
+        self.assertEqual('Accept-Ranges' in dict(new_headers), False)
+        self.assertEqual(dict(new_headers)['ETag'], 'W/"a"')
+        new_headers, entity = compression.compress({}, '200 OK', ranges,
+                                                   data)
+        self.assertEqual(dict(new_headers)['Accept-Ranges'], 'bytes')
+        self.assertEqual(dict(new_headers)['ETag'], '"a"')
+
+
+    def test_static_assets_gzip(self):
+        with Server('demo.hforge.org'):
+            path = '/ui/ikaaro/javascript.js'
+            for accept, gzip in [('gzip, deflate', True), ('gzip;q=0', False),
+                                 ('deflate', False)]:
+                environ = get_environ(path, HTTP_ACCEPT_ENCODING=accept)
+                status, headers, entity = get_response(environ)
+                headers = dict(headers)
+                self.assertEqual(status, '200 OK')
+                self.assertEqual(headers['Vary'], 'Accept-Encoding')
+                self.assertEqual(headers.get('Content-Encoding') == 'gzip',
+                                 gzip)
+
+
+    def test_template_registry(self):
+        with Server('demo.hforge.org') as server:
+            with server.database.init_context() as context:
+                template = context.get_template('/ui/ikaaro/auto_form.xml')
+                self.assertEqual(template.key.endswith('auto_form.xml.en'),
+                                 True)
+                self.assertEqual(
+                    template_registry.templates.get(template.key), template)
+                template = context.get_template('/ui/ikaaro/missing.xml')
+                self.assertEqual(template, None)
+
+
+    def test_fragment_cache(self):
+        with Server('demo.hforge.org') as server:
+            with server.database.init_context() as context:
+                calls = []
+                def make():
+                    calls.append(1)
+                    return 'hello'
+                for i in range(2):
+                    fragment = get_fragment(context, 'test', ('language',),
+                                            make, ['/config/footer'])
+                    self.assertEqual(fragment, 'hello')
+                self.assertEqual(len(calls), 1)
+                # Changing the source clears the fragment
+                fragment_cache.invalidate(['/config/footer'])
+                get_fragment(context, 'test', ('language',), make,
+                             ['/config/footer'])
+                self.assertEqual(len(calls), 2)
+
+
+    def test_bundles(self):
+        with Server('demo.hforge.org') as server:
+            with server.database.init_context() as context:
+                scripts = ['/ui/ikaaro/jquery.js', '/ui/ikaaro/javascript.js',
+                           'http://example.com/script.js']
+                bundle = static_assets.bundle(scripts, context)
+                self.assertEqual(len(bundle), 2)
+                self.assertEqual(bundle[1], scripts[2])
+                self.assertEqual(bundle[0].startswith('/ui/bundles/'), True)
+                retour = server.do_request('GET', bundle[0])
+                self.assertEqual(retour['status'], 200)
+                # Made again from the files of the query (another process)
+                path = bundle[0].split('?')[0]
+                static_assets.assets.pop(path)
+                query = '?files=%s,%s' % (scripts[1], scripts[0])
+                retour = server.do_request('GET', path + query)
+                self.assertEqual(retour['status'], 404)
+                self.assertEqual(static_assets.get(path), None)
+                retour = server.do_request('GET', bundle[0])
+                self.assertEqual(retour['status'], 200)
+                self.assertNotEqual(static_assets.get(path), None)
+
+
+    def test_bundle_scripts(self):
+        # The scripts are kept as they are (multi-line literals)
+        scripts = {
+            '/ui/test/a.js': 'var a = `first line\n\n    indented line`;',
+            '/ui/test/b.js': 'var b = "first line \\\n    second line";'}
+        for path, data in scripts.items():
+            static_assets.assets[path] = StaticAsset(None, data,
+                                                     'application/javascript')
+        try:
+            files = sorted(scripts)
+            asset = static_assets.get_bundle(files, None)
+            expected = ';\n'.join([ scripts[x] for x in files ])
+            self.assertEqual(asset.data, expected)
+        finally:
+            for path in scripts:
+                static_assets.assets.pop(path)
+
+
+    def test_minify_css(self):
+        data = ('/* comment */ a  ,  b { content: "a  b;  /* c */" ; '
+                'background: url( ../images/x.png ) ; }\n'
+                "p { content: 'it\\'s  here' }")
+        self.assertEqual(
+            minify_css(data, '/ui/test/css/style.css'),
+            'a,b{content: "a  b;  /* c */";'
+            'background: url(/ui/test/images/x.png);}'
+            "p{content: 'it\\'s  here'}")
+
+
+    def test_skin_files(self):
+        skin = skin_registry['ikaaro']
+        check_mtime = static_assets.check_mtime
+        try:
+            # Development environment: not kept
+            static_assets.check_mtime = True
+            skin.__dict__.pop('_styles', None)
+            skin.get_skin_styles()
+            self.assertEqual('_styles' in skin.__dict__, False)
+            static_assets.check_mtime = False
+            styles = skin.get_skin_styles()
+            self.assertIs(skin.get_skin_styles(), styles)
+        finally:
+            static_assets.check_mtime = check_mtime
+
+
     def test_server_404(self):
         with Server('demo.hforge.org') as server:
             with server.database.init_context():
@@ -167,6 +670,116 @@ class ServerTestCase(TestCase):
                 self.assertEqual(retour['entity'], {'text': 'hello sylvain'})
 
 
+    def test_multipart(self):
+        body = ('--XyZ\r\n'
+                'Content-Disposition: form-data; name="title"\r\n\r\n'
+                'hello\r\n'
+                '--XyZ\r\n'
+                'Content-Disposition: form-data; name="data"; '
+                'filename="C:\\tmp\\file.txt"\r\n'
+                'Content-Type: text/plain\r\n\r\n'
+                'hello\r\n--XyZ world\r\n'
+                '--XyZ\r\n'
+                'Content-Disposition: form-data; name="empty"; '
+                'filename=""\r\n\r\n\r\n'
+                '--XyZ--\r\n')
+        # Small chunks, so the delimiters are cut
+        chunk_size = multipart.chunk_size
+        multipart.chunk_size = 7
+        progress = []
+        try:
+            form = multipart.read_multipart(StringIO(body), len(body), 'XyZ',
+                                            lambda x, y: progress.append(x))
+        finally:
+            multipart.chunk_size = chunk_size
+        self.assertEqual(form['title'], 'hello')
+        self.assertEqual(form['empty'], None)
+        filename, mimetype, file = form['data']
+        self.assertEqual((filename, mimetype), ('file.txt', 'text/plain'))
+        self.assertEqual(file.read(), 'hello\r\n--XyZ world')
+        self.assertEqual(progress[-1], len(body))
+        # Malformed parts
+        for headers in ['Content-Type: text/plain',
+                        'Content-Disposition: form-data',
+                        'Content-Disposition form-data; name="title"']:
+            body = '--XyZ\r\n%s\r\n\r\nhello\r\n--XyZ--\r\n' % headers
+            self.assertRaises(ValueError, multipart.read_multipart,
+                              StringIO(body), len(body), 'XyZ')
+            environ = {'CONTENT_TYPE': 'multipart/form-data; boundary=XyZ',
+                       'CONTENT_LENGTH': str(len(body)),
+                       'wsgi.input': StringIO(body)}
+            self.assertRaises(ValueError, read_upload, environ, {})
+        # The request is rejected
+        body = ('--XyZ\r\n'
+                'Content-Disposition: form-data; name="title"\r\n\r\n'
+                'hel')
+        with Server('demo.hforge.org'):
+            environ = get_environ('/', REQUEST_METHOD='POST',
+                                  CONTENT_TYPE='multipart/form-data; '
+                                               'boundary=XyZ',
+                                  CONTENT_LENGTH=str(len(body)))
+            environ['wsgi.input'] = StringIO(body)
+            status, headers, entity = get_response(environ)
+            self.assertEqual(status, '400 Bad Request')
+
+
+    def test_forward_to_writer(self):
+        def writer(environ, start_response):
+            length = int(environ['CONTENT_LENGTH'])
+            body = environ['wsgi.input'].read(length)
+            headers = [('Content-Type', 'text/plain'),
+                       ('Set-Cookie', 'a=1'), ('Set-Cookie', 'b=2')]
+            start_response('200 OK', headers)
+            return [environ['REQUEST_METHOD'], ' ', body]
+        folder = mkdtemp()
+        address = '%s/writer.sock' % folder
+        writer_server = WSGIServer(make_listener(address), writer, log=None)
+        writer_server.start()
+        try:
+            with Server('demo.hforge.org') as server:
+                server.writer_address = address
+                # Bigger than a chunk
+                body = 'x' * 200000
+                environ = {'REQUEST_METHOD': 'POST', 'PATH_INFO': '/',
+                           'CONTENT_TYPE': 'text/plain',
+                           'CONTENT_LENGTH': str(len(body)),
+                           'wsgi.input': StringIO(body)}
+                response = {}
+                def start_response(status, headers):
+                    response['status'] = status
+                    response['headers'] = headers
+                chunks = list(worker_application(environ, start_response))
+                self.assertEqual(response['status'], '200 OK')
+                self.assertEqual(''.join(chunks), 'POST ' + body)
+                self.assertEqual(len(chunks) > 1, True)
+                cookies = [ value for name, value in response['headers']
+                            if name.lower() == 'set-cookie' ]
+                self.assertEqual(cookies, ['a=1', 'b=2'])
+                # The writer is down
+                server.writer_address = '%s/missing.sock' % folder
+                environ['wsgi.input'] = StringIO(body)
+                chunks = list(worker_application(environ, start_response))
+                self.assertEqual(response['status'].startswith('503'), True)
+        finally:
+            writer_server.stop()
+            rmtree(folder)
+
+
+    def test_start_workers_failure(self):
+        # The writer does not start: the workers are stopped and reaped
+        class FailingServer(object):
+            def __init__(self, *args, **kw):
+                raise RuntimeError('the server cannot start')
+        Server = server_module.Server
+        server_module.Server = FailingServer
+        try:
+            self.assertRaises(RuntimeError, server_module.start_workers,
+                              'demo.hforge.org', 2, port='18765')
+        finally:
+            server_module.Server = Server
+        self.assertRaises(OSError, waitpid, -1, WNOHANG)
+
+
     #def test_upload_file(self):
     #    with Server('demo.hforge.org') as server:
     #        with server.database.init_context(username='0'):
@@ -210,6 +823,120 @@ class ServerTestCase(TestCase):
         #        self.assertNotEqual(len(search), 0)
 
 
+    def test_allowed_viewers(self):
+        with Server('demo.hforge.org') as server:
+            with server.database.init_context() as context:
+                database = context.database
+                access = context.root.get_resource('/config/access')
+                access.touch_viewers_index()
+                while access.update_viewers_index():
+                    pass
+                database.save_changes()
+                self.assertEqual(access.is_viewers_index_ready(), True)
+                # Same results than the access rules queries (anonymous)
+                groups = set(['everybody'])
+                query = AndQuery(access.get_rules_query(groups, 'view'),
+                                 PhraseQuery('share', 'everybody'))
+                expected = database.search(query).get_documents()
+                query = access.get_viewers_query(None, groups)
+                results = database.search(query).get_documents()
+                self.assertEqual(set([ x.abspath for x in results ]),
+                                 set([ x.abspath for x in expected ]))
+                # A rule below the root, and an authenticated user
+                members = '/config/groups/members'
+                folder = context.root.make_resource('test-viewers', Folder)
+                folder.set_value('share', [members])
+                text = folder.make_resource('hello', Text)
+                text.set_value('share', [members])
+                rule = access.make_resource(None, AccessRule, group=members)
+                rule.set_value('permission', 'view')
+                rule.set_value('search_path', '/test-viewers')
+                rule.set_value('search_path_depth', '*')
+                user = context.root.make_user('test-viewers@hforge.org',
+                                              'password')
+                user.set_value('groups', [members])
+                database.save_changes()
+                while access.update_viewers_index():
+                    pass
+                database.save_changes()
+                userid = str(user.abspath)
+                groups = set(['everybody', 'authenticated', members])
+                share_query = OrQuery(*[ PhraseQuery('share', x)
+                                         for x in groups ])
+                share_query.append(PhraseQuery('share', userid))
+                query = AndQuery(access.get_rules_query(groups, 'view'),
+                                 share_query)
+                query = OrQuery(PhraseQuery('owner', userid), query)
+                expected = database.search(query).get_documents()
+                expected = set([ x.abspath for x in expected ])
+                query = access.get_viewers_query(user, groups)
+                results = database.search(query).get_documents()
+                results = set([ x.abspath for x in results ])
+                self.assertEqual(results, expected)
+                self.assertEqual('/test-viewers' in results, True)
+                self.assertEqual('/test-viewers/hello' in results, True)
+
+
+    def test_match_view_rule(self):
+        rule = ('everybody', '/test', None, None)
+        self.assertEqual(match_view_rule(rule, '/test', 'text'), True)
+        self.assertEqual(match_view_rule(rule, '/test/a/b', 'text'), True)
+        self.assertEqual(match_view_rule(rule, '/testing', 'text'), False)
+        rule = ('everybody', '/test', 1, 'text')
+        self.assertEqual(match_view_rule(rule, '/test', 'text'), True)
+        self.assertEqual(match_view_rule(rule, '/test/a', 'text'), True)
+        self.assertEqual(match_view_rule(rule, '/test/a/b', 'text'), False)
+        self.assertEqual(match_view_rule(rule, '/test/a', 'folder'), False)
+        rule = ('everybody', '/test', 0, None)
+        self.assertEqual(match_view_rule(rule, '/test', 'text'), True)
+        self.assertEqual(match_view_rule(rule, '/test/a', 'text'), False)
+
+
+    def test_has_permissions(self):
+        with Server('demo.hforge.org') as server:
+            with server.database.init_context() as context:
+                root = context.root
+                resources = [root, root.get_resource('config/theme'),
+                             root.get_resource('users')]
+                allowed = root.has_permissions(None, 'view', resources)
+                context.permissions.clear()
+                for resource in resources:
+                    self.assertEqual(str(resource.abspath) in allowed,
+                                     root.has_permission(None, 'view',
+                                                         resource))
+
+
+    def test_auth_cache(self):
+        with Server('demo.hforge.org') as server:
+            with server.database.init_context() as context:
+                database = context.database
+                root = context.root
+                user = root.make_user('test-auth-cache@hforge.org', 'password')
+                database.save_changes()
+                # Authenticate with the cookie
+                context.environ = {'HTTP_USER_AGENT': 'Firefox'}
+                context.login(user)
+                stats = auth_cache.stats
+                context.authenticate()
+                self.assertIs(context.user, user)
+                hit = stats['hit']
+                context.authenticate()
+                self.assertEqual(stats['hit'], hit + 1)
+                # Change the password: the cookie is not valid anymore
+                user.set_value('password', 'new password')
+                database.save_changes()
+                context.authenticate()
+                self.assertEqual(context.user, None)
+                # Delete the user
+                context.login(user)
+                context.authenticate()
+                self.assertIs(context.user, user)
+                root.del_resource(str(user.abspath))
+                database.save_changes()
+                context.authenticate()
+                self.assertEqual(context.user, None)
+
+
     def test_server_login_test_server(self):
         with Server('demo.hforge.org') as server:
             with server.database.init_context():
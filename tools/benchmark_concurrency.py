@@ -0,0 +1,104 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measure the latency of a running instance under a mixed load of read
+(GET) and write (POST) requests.
+
+Run it once with "database-lock = exclusive" and once with
+"database-lock = readers" to compare both modes. Example:
+
+  $ python benchmark_concurrency.py --clients=20 --requests=50 \\
+      --get-path=/;browse_content --write-ratio=0.1 http://localhost:8080
+"""
+
+# Import from the Standard Library
+from optparse import OptionParser
+from random import random
+from threading import Thread
+from time import time
+from urllib import urlencode
+from urllib2 import HTTPError, urlopen
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = int(round((len(values) - 1) * p / 100.0))
+    return values[index]
+
+
+def client(options, base_url, results):
+    get_url = base_url + options.get_path
+    post_url = base_url + options.post_path
+    post_data = urlencode({'loginname': 'nobody', 'password': 'nobody'})
+    for i in range(options.requests):
+        is_write = random() < options.write_ratio
+        t0 = time()
+        try:
+            if is_write:
+                response = urlopen(post_url, post_data)
+            else:
+                response = urlopen(get_url)
+            response.read()
+        except HTTPError, error:
+            error.read()
+        t1 = time()
+        results['POST' if is_write else 'GET'].append(t1 - t0)
+
+
+def report(name, values):
+    if not values:
+        return
+    print '%-5s n=%-6d p50=%.1fms p99=%.1fms max=%.1fms' % (
+        name, len(values),
+        percentile(values, 50) * 1000,
+        percentile(values, 99) * 1000,
+        max(values) * 1000)
+
+
+if __name__ == '__main__':
+    usage = '%prog [OPTIONS] URL'
+    parser = OptionParser(usage)
+    parser.add_option('--clients', type='int', default=10,
+                      help='number of concurrent clients')
+    parser.add_option('--requests', type='int', default=100,
+                      help='number of requests per client')
+    parser.add_option('--write-ratio', type='float', default=0.1,
+                      help='proportion of POST requests (0..1)')
+    parser.add_option('--get-path', default='/',
+                      help='path requested by GET')
+    parser.add_option('--post-path', default='/;login',
+                      help='path requested by POST')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('Wrong number of arguments.')
+    base_url = args[0].rstrip('/')
+
+    results = {'GET': [], 'POST': []}
+    threads = [ Thread(target=client, args=(options, base_url, results))
+                for i in range(options.clients) ]
+    t0 = time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    t1 = time()
+
+    n = len(results['GET']) + len(results['POST'])
+    print '%d requests in %.2f seconds (%.1f req/s)' % (n, t1 - t0,
+                                                       n / (t1 - t0))
+    report('GET', results['GET'])
+    report('POST', results['POST'])
@@ -0,0 +1,93 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measure the latency and the throughput of a running instance under a
+burst of small REST updates (the "rest_update" view), every client changes
+the title of its own resource.
+
+Run it once with "group-commit = 0" and once with, for example,
+"group-commit = 20" to compare both modes. The resources must exist, and
+the user must be allowed to edit them. Example:
+
+  $ python benchmark_group_commit.py --clients=20 --requests=50 \\
+      --auth=admin@example.com:password \\
+      http://localhost:8080/bench/{client}
+"""
+
+# Import from the Standard Library
+from base64 import b64encode
+from json import dumps
+from optparse import OptionParser
+from threading import Thread
+from time import time
+from urllib2 import HTTPError, Request, urlopen
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = int(round((len(values) - 1) * p / 100.0))
+    return values[index]
+
+
+def client(n, options, url, results):
+    url = url.format(client=n) + '/;rest_update'
+    headers = {'Content-Type': 'application/json'}
+    if options.auth:
+        headers['Authorization'] = 'Basic %s' % b64encode(options.auth)
+    for i in range(options.requests):
+        title = 'Client %d request %d' % (n, i)
+        data = dumps([['title', title, {'lang': 'en'}]])
+        t0 = time()
+        try:
+            response = urlopen(Request(url, data, headers))
+            response.read()
+        except HTTPError, error:
+            error.read()
+            results['errors'] += 1
+        results['latency'].append(time() - t0)
+
+
+if __name__ == '__main__':
+    usage = '%prog [OPTIONS] URL'
+    parser = OptionParser(usage)
+    parser.add_option('--clients', type='int', default=10,
+                      help='number of concurrent clients')
+    parser.add_option('--requests', type='int', default=20,
+                      help='number of requests per client')
+    parser.add_option('--auth',
+                      help='the credentials (login:password)')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('Wrong number of arguments.')
+
+    results = {'latency': [], 'errors': 0}
+    threads = [ Thread(target=client, args=(n, options, args[0], results))
+                for n in range(options.clients) ]
+    t0 = time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    t1 = time()
+
+    latency = results['latency']
+    print 'Requests: %d (%d errors)' % (len(latency), results['errors'])
+    print 'Throughput: %.1f requests/s' % (len(latency) / (t1 - t0))
+    print 'Latency: p50=%.1fms p99=%.1fms max=%.1fms' % (
+        percentile(latency, 50) * 1000,
+        percentile(latency, 99) * 1000,
+        max(latency) * 1000 if latency else 0)
@@ -0,0 +1,77 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measure the compression of the responses of a running instance: the
+bytes on the wire and the time to the last byte, with and without gzip, and
+the CPU time the server spends compressing the body at every level (see the
+"gzip-level" option). Example:
+
+  $ python benchmark_gzip.py --requests=20 \\
+      http://localhost:8080/;browse_content
+"""
+
+# Import from the Standard Library
+from optparse import OptionParser
+from time import clock, time
+from urllib2 import Request, urlopen
+import zlib
+
+
+def fetch(url, encoding, n):
+    """Return the body (as sent) and the average time to the last byte.
+    """
+    headers = {'Accept-Encoding': encoding} if encoding else {}
+    t0 = time()
+    for i in range(n):
+        response = urlopen(Request(url, headers=headers))
+        data = response.read()
+    t1 = time()
+    return data, response.info().get('Content-Encoding'), (t1 - t0) / n
+
+
+def compress(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+if __name__ == '__main__':
+    usage = '%prog [OPTIONS] URL'
+    parser = OptionParser(usage)
+    parser.add_option('--requests', type='int', default=10,
+                      help='number of requests per case')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('Wrong number of arguments.')
+    url = args[0]
+
+    # Over the wire
+    print 'Over the wire (%d requests)' % options.requests
+    plain, encoding, ttlb = fetch(url, None, options.requests)
+    print '  identity: %8d bytes  %.1fms' % (len(plain), ttlb * 1000)
+    data, encoding, ttlb = fetch(url, 'gzip', options.requests)
+    print '  %-8s: %8d bytes  %.1fms' % (encoding or 'identity', len(data),
+                                        ttlb * 1000)
+
+    # CPU cost
+    print 'CPU time to compress %d bytes' % len(plain)
+    n = options.requests
+    for level in range(1, 10):
+        t0 = clock()
+        for i in range(n):
+            data = compress(plain, level)
+        t1 = clock()
+        ratio = float(len(data)) / len(plain) if plain else 0
+        print '  level %d: %8d bytes (%3d%%)  %.2fms' % (
+            level, len(data), ratio * 100, (t1 - t0) / n * 1000)
@@ -0,0 +1,139 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Measure how a commit finds out the resources to re-index (step 2 of
+Database._before_commit) with a deep chain of dependencies: every resource
+of the chain depends on the previous one (onchange_reindex), so changing
+the first resource re-indexes all of them.
+
+Three ways are compared: re-searching all the paths found so far on every
+round (the old way), searching only the paths found in the previous round,
+and the in-memory index (see the "onchange-index" option). A new instance
+is made in a temporary folder. Example:
+
+  $ python benchmark_onchange.py --depth=500
+"""
+
+# Import from the Standard Library
+from optparse import OptionParser
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+# Import from itools
+from itools.database import OrQuery, PhraseQuery
+
+# Import from ikaaro
+from ikaaro.fields import Char_Field
+from ikaaro.folder import Folder
+from ikaaro.server import create_server
+from ikaaro.database import get_database
+from ikaaro.text import Text
+
+
+class Chain(Text):
+
+    class_id = 'benchmark-chain'
+
+    depends_on = Char_Field()
+
+
+    def get_onchange_reindex(self):
+        depends_on = self.get_value('depends_on')
+        return [depends_on] if depends_on else None
+
+
+
+def find_all_rounds(database, paths):
+    """The old way: every round searches all the paths found so far.
+    """
+    to_reindex = set()
+    aux = set()
+    aux2 = set(paths)
+    while len(aux) != len(aux2):
+        aux = set(aux2)
+        l_aux = list(aux)
+        for sub_aux in [l_aux[n:n+200] for n in range(0, len(l_aux), 200)]:
+            query = [ PhraseQuery('onchange_reindex', x) for x in sub_aux ]
+            search = database.search(OrQuery(*query))
+            for brain in search.get_documents():
+                aux2.add(brain.abspath)
+                to_reindex.add(brain.abspath)
+    return to_reindex
+
+
+def find_frontier(database, paths):
+    to_reindex = set()
+    seen = set(paths)
+    frontier = seen
+    while frontier:
+        sources = database.get_onchange_reindex(frontier)
+        to_reindex.update(sources)
+        frontier = sources - seen
+        seen.update(frontier)
+    return to_reindex
+
+
+def measure(name, database, find, paths):
+    searches = []
+    search = database.search
+    def counter(*args, **kw):
+        searches.append(args)
+        return search(*args, **kw)
+    database.search = counter
+    t0 = time()
+    found = find(database, paths)
+    t1 = time()
+    del database.search
+    print '%-10s %6d found %6d searches %8.1fms' % (
+        name, len(found), len(searches), (t1 - t0) * 1000)
+
+
+if __name__ == '__main__':
+    usage = '%prog [OPTIONS]'
+    parser = OptionParser(usage)
+    parser.add_option('--depth', type='int', default=200,
+                      help='number of resources in the chain')
+    options, args = parser.parse_args()
+
+    target = mkdtemp() + '/instance'
+    try:
+        create_server(target, 'nobody@example.com', 'password', None)
+        database = get_database(target, 19500, 20500)
+        # Make the chain
+        with database.init_context():
+            root = database.get_resource('/')
+            folder = root.make_resource('chain', Folder)
+            depends_on = None
+            for i in range(options.depth):
+                resource = folder.make_resource(str(i), Chain)
+                if depends_on:
+                    resource.set_value('depends_on', depends_on)
+                depends_on = str(resource.abspath)
+            database.save_changes()
+
+            # Change the first resource
+            print 'Chain of %d resources' % options.depth
+            paths = ['/chain/0']
+            measure('all', database, find_all_rounds, paths)
+            measure('frontier', database, find_frontier, paths)
+            t0 = time()
+            database.load_onchange_index()
+            t1 = time()
+            measure('index', database, find_frontier, paths)
+            print '(index loaded in %.1fms)' % ((t1 - t0) * 1000)
+        database.close()
+    finally:
+        rmtree(target.rsplit('/', 1)[0])